@@ -120,7 +120,7 @@ class Assistant:
                 if 'function_call' in m:
                     del m['function_call']
 
-            toks = len(self.tokenizer.encode(json.dumps(m)))
+            toks = len(self.tokenizer.encode(dumps(m)))
 
             if toks < max_tokens:
                 max_tokens -= toks
@@ -139,7 +139,8 @@ class Assistant:
 
         sm = self.tools.system_message().format(specialization=specialization)
 
-        logger.debug(log_debug(f"System message: {sm}"))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(log_debug(f"System message: {sm}"))
 
         return [{'role': 'system', 'content': sm}] + rm
 
@@ -246,7 +247,7 @@ class Assistant:
                     pass  # IDK what to do here.
 
                 case _:
-                    logger.debug(f"Unknown finish reason: {finish_reason}")
+                    logger.debug("Unknown finish reason: %s", finish_reason)
 
         return finish_reason
 
@@ -284,8 +285,10 @@ class Assistant:
                 logger.error(log_error(f"Unknown task state: {self.task_state}"))
                 line = getline()
 
-        logger.info(log_debug(self.task_state.name))
-        logger.debug(log_debug(f"Line: {line}"))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(log_debug(self.task_state.name))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(log_debug(f"Line: {line}"))
 
         if isinstance(line, str) and line.startswith('%'):
             line = line[1:]
@@ -319,7 +322,7 @@ class Assistant:
     def count_tokens(self, r):
 
         if not isinstance(r, str):
-            r = json.dumps(r, indent=2)
+            r = dumps(r, indent=2)
 
         return len(self.tokenizer.encode(r))
 
@@ -358,7 +361,7 @@ class Assistant:
             else:
 
                 if not isinstance(r, str):
-                    r = json.dumps(r, indent=2)
+                    r = dumps(r, indent=2)
 
                 toks = self.count_tokens(r)
 
@@ -370,7 +373,8 @@ class Assistant:
 
                     logger.error(log_error('Response too long to return to model.'))
                 else:
-                    logger.info(log_system(f"Response: {r[:200]}"))
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info(log_system(f"Response: {r[:200]}"))
 
                 m['content'] = r
                 messages.append(m)
@@ -142,7 +142,8 @@ def init(args):
 
     # tool = TaskManager(ts, rc.sub('task-manager'), Path('/Volumes/Cache/scratch'))
 
-    tool = PPTools(ts, args.dir)
+    tool = PPTools(ts, args.dir, prewarm=True)
+    tool.set_session_cache(rc.sub('session-cache'))
 
     assis = Assistant(cache=rc, model=args.model)
     assis.set_tools(tool)
@@ -15,10 +15,16 @@ class FSAccess:
             fs (Path|str|AbstractFileSystem): The file system or file system path to use.
         """
         if isinstance(fs, (Path, str)):
+            self.root = Path(fs)  # Local files are read and written directly
             self.fs = DirFileSystem(str(fs),LocalFileSystem())
         else:
+            self.root = None
             self.fs = fs
 
+    def _local_path(self, path: str) -> Path:
+        # Like DirFileSystem, treat absolute paths as relative to the root
+        return self.root.joinpath(path.lstrip('/'))
+
     def read(self, path: str, encoding=None) -> str:
         """
         Read text from a file.
@@ -30,6 +36,9 @@ class FSAccess:
         Returns:
             str: The content of the file as a string.
         """
+        if self.root is not None:
+            return self._local_path(path).read_text(encoding=encoding)
+
         with self.fs.open(path, "r", encoding=encoding) as f:
             return f.read()
 
@@ -42,9 +51,53 @@ class FSAccess:
             b (str): The text content to write to the file.
             encoding (str, optional): The encoding to use for writing the file.
         """
+        if self.root is not None:
+            self._local_path(path).write_text(b, encoding=encoding)
+            return
+
         with self.fs.open(path, "w", encoding=encoding) as f:
             f.write(b)
 
+    def read_many(self, paths: list[str], encoding=None, max_workers: int = 8) -> list[str]:
+        """
+        Read text from several files, concurrently.
+
+        Args:
+            paths (list[str]): The paths to the files to be read.
+            encoding (str, optional): The encoding to use for reading the files.
+            max_workers (int, optional): The number of files to read at once.
+
+        Returns:
+            list[str]: The content of each file, in the same order as the paths.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if len(paths) <= 1:
+            return [self.read(p, encoding=encoding) for p in paths]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda p: self.read(p, encoding=encoding), paths))
+
+    def write_many(self, files: dict[str, str], encoding=None, max_workers: int = 8) -> None:
+        """
+        Write text to several files, concurrently.
+
+        Args:
+            files (dict[str, str]): A mapping of file paths to the text to write to them.
+            encoding (str, optional): The encoding to use for writing the files.
+            max_workers (int, optional): The number of files to write at once.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if len(files) <= 1:
+            for p, b in files.items():
+                self.write(p, b, encoding=encoding)
+            return
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Consume the iterator so exceptions from the writes are raised
+            list(executor.map(lambda pb: self.write(pb[0], pb[1], encoding=encoding), files.items()))
+
     def ls(self, path: str) -> list:
         """
         List files in a directory.
@@ -17,6 +17,7 @@ class IpyKernel:
     startup_code = dedent(f"""
     %load_ext autoreload
     %autoreload 2
+    import codecs as _pp_codecs, pickle as _pp_pickle
     """).strip()
 
     def __init__(self):
@@ -28,8 +29,9 @@ class IpyKernel:
 
         self.messages = defaultdict(list)  # Messages received from the kernel
 
-    def start(self):
-        """Start the kernel and the client"""
+    def start(self, cwd=None):
+        """Start the kernel and the client, with the kernel running in the
+        directory cwd, if it is given"""
 
         from os import environ
 
@@ -41,7 +43,10 @@ class IpyKernel:
         #warnings.simplefilter('ignore')
 
         self.kernel_manager = KernelManager()
-        self.kernel_manager.start_kernel()
+        if cwd is not None:
+            self.kernel_manager.start_kernel(cwd=str(cwd))
+        else:
+            self.kernel_manager.start_kernel()
         self.client = self.kernel_manager.blocking_client()
         self.client.start_channels()
         self.exec(self.startup_code, timeout=None)
@@ -64,11 +69,8 @@ class IpyKernel:
     def get_var(self, varname):
         """Return a named variable from the kernel"""
 
-        code = f"""
-        import codecs
-        import pickle
-        print(codecs.encode(pickle.dumps({varname}), "base64").decode());
-        """
+        # The modules are imported into the kernel once, in startup_code
+        code = f'print(_pp_codecs.encode(_pp_pickle.dumps({varname}), "base64").decode())'
 
         e = self.exec(code)
         try:
@@ -93,7 +95,7 @@ class IpyKernel:
         from queue import Empty
 
         msgid = self.client.execute(code)
-        logger.debug(f"Execute code, ({code[:20]}...),  msgid={msgid}")
+        logger.debug("Execute code, (%s...),  msgid=%s", code[:20], msgid)
 
         if timeout is None:
             return None, None
@@ -109,7 +111,7 @@ class IpyKernel:
                 if parent.get("msg_id") == msgid:
                     del reply["parent_header"]
 
-                    logger.debug(f"{msgid}: {reply['msg_type']} {reply['content']} {reply}")
+                    logger.debug("%s: %s %s %s", msgid, reply['msg_type'], reply['content'], reply)
 
                     if reply["content"].get("execution_state") == "idle":
                         sm = self.return_stream(msgid)
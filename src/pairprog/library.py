@@ -1,20 +1,32 @@
+import asyncio
+import hashlib
 import io
 import logging
+import sqlite3
+import threading
 import unittest
+from array import array
+from dataclasses import dataclass
 from os import environ
+from typing import List
 
 import PyPDF2
 import requests
 import typesense
 from langchain.text_splitter import CharacterTextSplitter
 from markdownify import markdownify as md
-from typesense.exceptions import ObjectAlreadyExists
+from typesense.exceptions import ObjectAlreadyExists, ObjectNotFound
 from bs4 import BeautifulSoup
 import tiktoken
 logger = logging.getLogger(__name__)
 from more_itertools import chunked
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 def extract_text_from_pdf_bytes(pdf_bytes):
     """
     Extract text from a PDF file represented as a byte object.
@@ -191,12 +203,250 @@ def process_content(text, chunk_size=500, chunk_overlap=50):
     return chunks
 
 
+def quantize(v: list[float]) -> tuple[bytes, float]:
+    """Scalar-quantize a vector to int8, returning the bytes and the scale
+    needed to restore it"""
+    scale = max(map(abs, v), default=0.0) / 127 or 1.0
+    return array('b', [max(-127, min(127, round(e / scale))) for e in v]).tobytes(), scale
+
+
+def dequantize(b: bytes, scale: float) -> list[float]:
+    """Restore a vector from quantize()"""
+    return [e * scale for e in array('b', b)]
+
+
+_STOPWORDS = frozenset("""a an and are as at be by can do does for from how i in is it
+of on or should the to was what when where which who why will with""".split())
+
+
+def _is_keyword_query(text: str) -> bool:
+    """Return True if a query looks like a few keywords, rather than a
+    natural language question"""
+    words = text.lower().split()
+
+    return len(words) <= 3 and not any(w.strip('?.,!"\'') in _STOPWORDS for w in words)
+
+
+def json_loads(s):
+    """Parse JSON with orjson, if it is installed"""
+    return orjson.loads(s) if orjson is not None else json.loads(s)
+
+
+def dumps_jsonl(docs) -> bytes:
+    """Serialize documents to a JSONL body for the Typesense import API"""
+    if orjson is not None:
+        return b"\n".join(orjson.dumps(d) for d in docs)
+    else:
+        return "\n".join(json.dumps(d) for d in docs).encode('utf8')
+
+
+def loads_jsonl(s) -> list:
+    """Parse a JSONL response from the Typesense import or export API"""
+    if isinstance(s, bytes):
+        s = s.decode('utf8')
+
+    return [json_loads(e) for e in s.splitlines() if e]
+
+
+def _node_config(node) -> dict:
+    return {"host": node.host, "port": node.port, "protocol": node.protocol,
+            "path": getattr(node, 'path', '')}
+
+
+def client_with_timeout(client: typesense.Client, timeout: float | None) -> typesense.Client:
+    """Return a new client with the same configuration as `client`, except for
+    the connection timeout. If timeout is None, or the same as the client's,
+    return the client itself."""
+    config = client.config
+
+    if timeout is None or timeout == config.connection_timeout_seconds:
+        return client
+
+    # The Configuration attributes have the same names as the keys of the
+    # config dict they were read from, except for the nodes, which are objects
+    d = {k: v for k, v in vars(config).items()
+         if k not in ('validations', 'nodes', 'nearest_node')}
+    d['nodes'] = [_node_config(n) for n in config.nodes]
+    if getattr(config, 'nearest_node', None) is not None:
+        d['nearest_node'] = _node_config(config.nearest_node)
+    d['connection_timeout_seconds'] = timeout
+
+    return typesense.Client(d)
+
+
+def configure_connection_pool(client: typesense.Client, pool_connections: int = 16,
+                              pool_maxsize: int = 64, max_retries: int = 0):
+    """Mount a keep-alive connection pool on the requests sessions that the
+    Typesense client sends its requests through, so that bulk operations reuse
+    connections rather than opening a new one per request. Depending on the
+    SDK version, the session is on the client's ApiCall or is shared by the
+    api_call module. Returns the number of sessions configured.
+
+    This only affects the 0.x SDKs, which use requests. The 2.x SDK sends
+    requests through httpx, which already pools connections; its pool is sized
+    with the max_connections and max_keepalive_connections keys of the client
+    config, which client_with_timeout() copies to the clients it makes."""
+    if hasattr(client.config, 'max_connections'):
+        logger.debug("Typesense client pools its own connections; see its max_connections config")
+        return 0
+
+    from requests import Session
+    from requests.adapters import HTTPAdapter
+
+    api_call = getattr(client, 'api_call', None)
+    candidates = list(vars(api_call).values()) if api_call is not None else []
+
+    try:
+        import typesense.api_call
+        candidates += list(vars(typesense.api_call).values())
+    except ImportError:
+        pass  # Newer versions of the SDK have no shared session
+
+    n = 0
+    for session in {id(c): c for c in candidates if isinstance(c, Session)}.values():
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                              max_retries=max_retries, pool_block=False)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        n += 1
+
+    if n == 0:
+        logger.debug("No requests session found on the Typesense client; connection pool not configured")
+
+    return n
+
+
+class EmbeddingCache:
+    """An on-disk cache of text embeddings, in a SQLite database, keyed by the
+    SHA-256 hash of the text. Vectors are stored as float32 blobs, or, with
+    quantize=True, as int8 blobs with a per-vector scale, which is 4x smaller
+    at a small cost in precision."""
+
+    def __init__(self, path, quantize: bool = False):
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.lock = threading.Lock()
+        self.quantize = quantize
+
+        with self.lock, self.db:
+            # scale is NULL for float32 vectors
+            self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (hash BLOB PRIMARY KEY, vec BLOB, scale REAL)")
+
+    @staticmethod
+    def key(text: str, model: str = '') -> bytes:
+        """Return the cache key for a text, embedded with a model"""
+        return hashlib.sha256(f"{model}\0{text}".encode('utf8')).digest()
+
+    def get_many(self, keys: list[bytes]) -> dict[bytes, list[float]]:
+        """Return a dict of the vectors for the keys that are in the cache"""
+        o = {}
+        with self.lock:
+            # Stay under SQLite's limit on the number of query parameters
+            for batch in chunked(keys, 500):
+                q = f"SELECT hash, vec, scale FROM embeddings WHERE hash IN ({','.join('?' * len(batch))})"
+                for h, vec, scale in self.db.execute(q, batch):
+                    o[h] = array('f', vec).tolist() if scale is None else dequantize(vec, scale)
+        return o
+
+    def put_many(self, items: dict[bytes, list[float]]):
+        if self.quantize:
+            rows = [(h, *quantize(v)) for h, v in items.items()]
+        else:
+            rows = [(h, array('f', v).tobytes(), None) for h, v in items.items()]
+
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO embeddings (hash, vec, scale) VALUES (?, ?, ?)", rows)
+
+
+def _item(v):
+    """Convert a numpy scalar to a Python number, or None if it is NaN"""
+    v = v.item()
+    return None if v != v else v
+
+
+@dataclass
+class SearchVectors:
+    """Search results as parallel arrays, one entry per hit, for re-ranking
+    with vectorized operations. Scores that a search didn't produce, such as
+    text_match for a vector-only search, are NaN."""
+    ids: "np.ndarray"
+    text_match: "np.ndarray"
+    vector_distance: "np.ndarray"
+    rank_fusion_score: "np.ndarray"
+    documents: list
+
+    def __len__(self):
+        return len(self.ids)
+
+    def to_dicts(self) -> list:
+        """Return the hits in the same form as Library.search()"""
+        hits = []
+        for i, doc in enumerate(self.documents):
+            doc = dict(doc)
+            doc['_text_match_info'] = {
+                'text_match': _item(self.text_match[i]),
+                'vector_distance': _item(self.vector_distance[i]),
+                'rank_fusion_score': _item(self.rank_fusion_score[i]),
+            }
+            hits.append(doc)
+
+        return hits
+
+
 class Library:
-    def __init__(self, client: typesense.Client | None):
-        self.client = client
+    def __init__(self, client: typesense.Client | None, batch_size: int = 100,
+                 embedding_cache: str | None = None, quantize_embeddings: bool = False,
+                 ingest_timeout: float = 30, search_timeout: float | None = None):
+        """
+        :param client: Typesense client. The library makes two clients for the
+            same servers from it, with the ingest and search timeouts.
+        :param batch_size: Number of documents per bulk import request
+        :param embedding_cache: Path to a SQLite file for caching embeddings. If set,
+            document embeddings are computed here, through the cache, rather than by
+            Typesense, so text that has been embedded before is not embedded again.
+        :param quantize_embeddings: Store cached embeddings as int8
+        :param ingest_timeout: Timeout, in seconds, for imports and collection
+            changes, which may wait for the server to embed the documents. A short
+            timeout here makes the client retry, and the documents get embedded again.
+        :param search_timeout: Timeout, in seconds, for searches and retrieval.
+            Defaults to the timeout of `client`.
+        """
+        if client is not None:
+            self.client = client_with_timeout(client, ingest_timeout)
+            self.search_client = client_with_timeout(client, search_timeout)
+            self.search_timeout = self.search_client.config.connection_timeout_seconds
+        else:
+            self.client = self.search_client = None
+            self.search_timeout = search_timeout
+
+        self.batch_size = batch_size  # Documents per import request
+        self._buffer: list[dict] = []  # Documents queued for the next import
+
+        if embedding_cache:
+            self.embedding_cache = EmbeddingCache(embedding_cache, quantize=quantize_embeddings)
+        else:
+            self.embedding_cache = None
+
+        if self.client is not None:
+            configure_connection_pool(self.client)
+            configure_connection_pool(self.search_client)
+
+        self._bind_collection()
+
+    def _bind_collection(self):
+        """Cache the handles for the library collection and its documents"""
+        if self.client is not None:
+            self._lib = self.client.collections[self.collection_alias]
+            self._docs = self._lib.documents
+            self._search_docs = self.search_client.collections[self.collection_alias].documents
+        else:
+            self._lib = self._docs = self._search_docs = None
+
+    # Documents are read and written through this alias, which points at the
+    # collection for the current version of the schema
+    collection_alias = "library"
 
     library_schema = {
-        "name": "library",
+        "name": "library_v2",
         "fields": [
             {"name": "title", "type": "string"},
             {"name": "description", "type": "string", "optional": True},
@@ -207,46 +457,135 @@ class Library:
             {
                 "name": "embedding",
                 "type": "float[]",
+                "num_dim": 512,
+                "hnsw_params": {"M": 16, "ef_construction": 100},
                 "embed": {
                     "from": ["text"],
                     "model_config": {
-                        "model_name": "openai/text-embedding-ada-002",
+                        "model_name": "openai/text-embedding-3-small",
                         "api_key": environ.get("OPENAI_API_KEY"),
+                        "dimensions": 512,
                     },
                 },
             },
         ],
     }
 
-    def _create_collection(self, sch, delete=False):
-        logger.debug(f"Loading {sch['name']} schema")
+    # Named values for the search-time ef of the HNSW index. Lower is faster,
+    # with lower recall.
+    ef_presets = {"fast": 32, "default": 64, "accurate": 256}
+
+    @staticmethod
+    def _schema_hash(sch) -> str:
+        """Return a hash of the parts of a collection schema that determine the
+        index: the name, type and dimensions of each field, and the embedding
+        model. It works the same on our schema and on the one that the server
+        returns for a collection, which adds defaults and hides the API key."""
+
+        fields = []
+        for f in sch["fields"]:
+            model = f.get("embed", {}).get("model_config", {}).get("model_name")
+            fields.append((f["name"], f["type"], bool(f.get("optional", False)),
+                           f.get("num_dim"), model))
+
+        return hashlib.sha1(json.dumps(sorted(fields)).encode('utf8')).hexdigest()
+
+    def _schema_changed(self, sch) -> bool:
+        """Return True if the existing collection for a schema was created with
+        a different schema"""
+        live = self.client.collections[sch["name"]].retrieve()
+
+        return self._schema_hash(live) != self._schema_hash(sch)
+
+    def _create_collection(self, sch, delete=False, alias=True, force=False):
+        logger.debug("Loading %s schema", sch['name'])
 
         try:
             self.client.collections.create(sch)
         except ObjectAlreadyExists:
-            if delete:
-                logger.debug(
-                    f"Collection {sch['name']} already exists, deleting and recreating"
-                )
+            if delete and not force and not self._schema_changed(sch):
+                logger.debug("Collection %s already exists with the same schema, skipping", sch['name'])
+            elif delete:
+                logger.debug("Collection %s already exists, deleting and recreating", sch['name'])
                 self.client.collections[sch["name"]].delete()
                 self.client.collections.create(sch)
             else:
-                logger.debug(f"Collection {sch['name']} already exists, skipping")
-                return
+                logger.debug("Collection %s already exists, skipping", sch['name'])
+
+        if alias:
+            self.client.aliases.upsert(self.collection_alias, {"collection_name": sch["name"]})
+
+        # The old collection handle may refer to a deleted collection
+        self._bind_collection()
+
+    def _has_legacy_collection(self) -> bool:
+        """Return True if there is a collection, rather than an alias, with the
+        name of the library alias, as created by older versions"""
+        try:
+            # Retrieving an alias returns the collection it points to
+            live = self.client.collections[self.collection_alias].retrieve()
+        except ObjectNotFound:
+            return False
+
+        return live["name"] == self.collection_alias
+
+    def create_collection(self, delete=False, force=False, migrate=False):
+        """Create a collection with the given name and schema. With delete=True,
+        an existing collection is deleted and recreated if its schema is different
+        from the current one, or always, if force=True.
+
+        A collection from an older version that has the name of the library alias
+        is copied into the new collection with migrate=True, and otherwise raises
+        ObjectAlreadyExists, since the alias can't be created while it exists."""
+
+        if self._has_legacy_collection():
+            if not migrate:
+                raise ObjectAlreadyExists(
+                    f"There is an old collection named '{self.collection_alias}'. Move its "
+                    f"documents to '{self.library_schema['name']}' with migrate_collection(), "
+                    f"or call create_collection(migrate=True)")
+
+            self.migrate_collection(self.collection_alias)
+            return
+
+        self._create_collection(self.library_schema, delete=delete, force=force)
+
+    def migrate_collection(self, old_name: str = "library", batch_size: int = None):
+        """Copy the documents in an old collection into the collection for the
+        current schema, where they are embedded again with the current model.
+        Then delete the old collection and point the library alias at the new one."""
+
+        new_name = self.library_schema["name"]
+        assert old_name != new_name, "Old and new collections are the same"
+
+        self._create_collection(self.library_schema, alias=False)
+
+        new_docs = self.client.collections[new_name].documents
+
+        docs = (json_loads(e) for e in self.client.collections[old_name].documents.export().splitlines())
+        docs = ({k: v for k, v in d.items() if k != 'embedding'} for d in docs)
+
+        n = 0
+        for batch in chunked(docs, batch_size or self.batch_size):
+            self._check_import(self._import(new_docs, batch, {"action": "upsert"}))
+            n += len(batch)
+
+        # The alias can't have the same name as a collection
+        self.client.collections[old_name].delete()
+        self.client.aliases.upsert(self.collection_alias, {"collection_name": new_name})
+        self._bind_collection()
 
-    def create_collection(self, delete=False):
-        """Create a collection with the given name and schema"""
-        self._create_collection(self.library_schema, delete=delete)
+        return n
 
     def clear_collection(self):
         """Clear the collection"""
-        return self.client.collections["library"].documents.delete({"filter_by": "chunk:>=0"})
+        return self._docs.delete({"filter_by": "chunk:>=0"})
 
     def list(self):
         """List all documents in the collection"""
-        r = self.client.collections["library"].documents.export()
+        r = self._docs.export()
         for e in r.splitlines():
-            d = json.loads(e)
+            d = json_loads(e)
             del d['embedding']
 
             d = {key: d[key] for key in sorted(d.keys())}
@@ -256,17 +595,119 @@ class Library:
     def count(self):
         return len(list(self.list()))
 
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        """Compute embeddings with the same model that the schema uses"""
+        import openai
+
+        model_config = self.library_schema['fields'][-1]['embed']['model_config']
+        model = model_config['model_name'].removeprefix('openai/')
+
+        # Shortened embeddings, for the models that support them
+        kwargs = {'dimensions': model_config['dimensions']} if 'dimensions' in model_config else {}
+
+        r = openai.OpenAI(api_key=model_config['api_key']).embeddings.create(model=model, input=texts, **kwargs)
+
+        return [e.embedding for e in r.data]
+
+    def _add_embeddings(self, docs: List[dict]):
+        """Set the embedding field for documents from the embedding cache, computing
+        and caching the embeddings that are missing"""
+
+        model = self.library_schema['fields'][-1]['embed']['model_config']['model_name']
+        keys = [EmbeddingCache.key(doc['text'], model) for doc in docs]
+        vectors = self.embedding_cache.get_many(keys)
+
+        missing = list({k: doc['text'] for k, doc in zip(keys, docs) if k not in vectors}.items())
+
+        if missing:
+            new = dict(zip([k for k, _ in missing], self._embed([t for _, t in missing])))
+            self.embedding_cache.put_many(new)
+            vectors.update(new)
+
+        for k, doc in zip(keys, docs):
+            doc['embedding'] = vectors[k]
+
+    def add_documents(self, docs: List[dict], action: str = "upsert", batch_size: int = None):
+        """Add a list of documents with the bulk import API, batch_size documents
+        per request, and raise an IOError if any of them fail to import"""
+
+        # Copies without the None fields, which Typesense rejects. The copies
+        # also keep the embeddings from being added to the caller's documents.
+        docs = ({k: v for k, v in doc.items() if v is not None} for doc in docs)
+
+        return self._add_documents(docs, action=action, batch_size=batch_size)
+
+    def _add_documents(self, docs, action: str = "upsert", batch_size: int = None):
+        """Like add_documents(), for documents built by the library, which have no
+        None fields and can be modified"""
+
+        batch_size = batch_size or self.batch_size
+
+        r = []
+        for batch in chunked(docs, batch_size):
+            if self.embedding_cache is not None:
+                self._add_embeddings(batch)
+
+            r.extend(self._import(self._docs, batch, {"action": action, "batch_size": batch_size}))
+
+        return self._check_import(r)
+
+    @staticmethod
+    def _import(documents, batch, params):
+        """Import a batch of documents, serializing the JSONL body ourselves, with
+        orjson when it is available, rather than letting the SDK encode
+        each document with the json module"""
+        return loads_jsonl(documents.import_(dumps_jsonl(batch), params))
+
+    @staticmethod
+    def _check_import(r):
+        """Raise an IOError if any rows of an import response failed"""
+        errors = [e for e in r if not e.get('success')]
+        if errors:
+            raise IOError(f"Failed to import {len(errors)} of {len(r)} documents. "
+                          f"First error: {errors[0].get('error')}")
+
+        return r
+
+    def add_documents_parallel(self, docs: List[dict], workers: int = 4, action: str = "upsert",
+                               batch_size: int = None):
+        """Like add_documents(), but import the batches concurrently, from `workers`
+        threads. Keep workers at or below the number of indexing threads on the
+        Typesense server; more will only queue up on the server."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        batch_size = batch_size or self.batch_size
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda batch: self.add_documents(batch, action=action, batch_size=batch_size),
+                                   chunked(docs, batch_size))
+
+            return [e for r in results for e in r]
+
+    def queue_document(self, doc: dict):
+        """Queue a document to be added in the next bulk import, which happens when
+        the queue has batch_size documents, or when flush() is called"""
+        self._buffer.append(doc)
+
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self, action: str = "upsert"):
+        """Import all of the queued documents"""
+        if not self._buffer:
+            return []
+
+        docs, self._buffer = self._buffer, []
+
+        return self.add_documents(docs, action=action)
+
     def _add_document(self, doc):
 
         doc = {k: v for k, v in doc.items() if v is not None}
 
-        if "id" in doc:
-            r = self.client.collections["library"].documents.upsert(id)
-        else:
-            r = self.client.collections["library"].documents.create(doc)
+        r = dict(doc)  # Before the import adds the embedding to doc
 
-        if 'embedding' in r:
-            del r['embedding']
+        self._add_documents([doc])
 
         if len(r['text']) > 200:
             r['text'] = '...' + r['text'][-200:]
@@ -291,6 +732,31 @@ class Library:
         :return: Dictionary with non-None arguments
         """
 
+        title, docs = self._document_chunks(title, text, description, source, tags)
+
+        self._add_documents(docs)
+
+        return {"title": title, 'source': source, "chunks": len(docs)}
+
+    def add_document_batch(self, documents: List[dict]) -> List[dict]:
+        """Add several documents, each a dict of the arguments to add_document(),
+        importing the chunks of all of them together"""
+
+        docs, r = [], []
+        for d in documents:
+            title, chunks = self._document_chunks(d.get('title'), d.get('text'), d.get('description'),
+                                                  d.get('source'), d.get('tags'))
+            docs.extend(chunks)
+            r.append({"title": title, 'source': d.get('source'), "chunks": len(chunks)})
+
+        self._add_documents(docs)
+
+        return r
+
+    @staticmethod
+    def _document_chunks(title, text, description, source, tags):
+        """Split a document into chunks, returning the title and the chunk documents"""
+
         if text is None and source is not None:
             text = download_or_open(source)
 
@@ -300,67 +766,181 @@ class Library:
 
         title = title or chunks[0].splitlines()[0]
 
-        from tqdm import tqdm
+        # The optional fields are the same for every chunk
+        extra = {}
+        if description is not None:
+            extra["description"] = description
+        if source is not None:
+            extra["source"] = source
+        if tags is not None:
+            extra["tags"] = tags
 
         docs = []
         for chunk_n, chunk in enumerate(chunks):
-            doc = {
-                "title": title,
-                "description": description,
-                "source": source,
-                "chunk": chunk_n,
-                "tags": tags,
-                "text": chunk
-            }
+            doc = {"title": title, "chunk": chunk_n, "text": chunk}
+            doc.update(extra)
             docs.append(doc)
 
-        r = self.client.collections["library"].documents.import_(docs)
-
-        return {"title": title, 'source': source, "chunks": len(docs)}
+        return title, docs
 
 
     # noinspection PyUnusedLocal
-    def _search(self, text, tags=None):
-        """Search the collection for a given query"""
+    def _search_query(self, text, tags=None, hybrid=False, ef=None):
+        """Return the search parameters for a query.
+
+        Natural language questions are matched only against the embedding,
+        since keyword scoring on a question mostly adds noise and costs a scan
+        of the text fields. Short keyword queries, or any query with
+        hybrid=True, go to both the text fields and the embedding, and the
+        results are ranked by rank fusion. The text field is included because
+        the title and description are the same for every chunk of a document.
+
+        ef sets the size of the candidate list for the vector search, either as
+        a number or the name of one of the ef_presets. If it is None, the
+        server's default is used.
+        """
+        if hybrid or _is_keyword_query(text):
+            query_by = "title, description, text, embedding"
+        else:
+            query_by = "embedding"
 
-        query = {"q": text,
-                 "query_by": "description, embedding",
-                 "prefix": False,
-                 "exclude_fields": "embedding"}
+        q = {"q": text,
+             "query_by": query_by,
+             "prefix": False,
+             "exclude_fields": "embedding"}
 
-        r = self.client.collections["library"].documents.search(query)
+        if ef is not None:
+            ef = self.ef_presets.get(ef, ef)
+            q["vector_query"] = f"embedding:([], ef:{int(ef)})"
 
-        return r
+        return q
 
     # noinspection PyUnusedLocal
-    def search(self, text, tags=None):
+    def _search(self, text, tags=None, hybrid=False, ef=None):
+        """Search the collection for a given query"""
 
-        r = self._search(text)
+        r = self._search_docs.search(self._search_query(text, tags, hybrid, ef))
 
-        hits = []
+        return r
+
+    @staticmethod
+    def _consolidate_hits(r):
+        """Return the documents from a search response, with the match
+        information for each gathered into its _text_match_info. Keyword and
+        vector only searches leave out some of the match fields, which are set
+        to None"""
+
+        hits = [None] * len(r['hits'])
         # Consoldate some of the results fields
-        for h in r['hits']:
-            tmi = h['text_match_info']
-            tmi['rank_fusion_score'] = h['hybrid_search_info']['rank_fusion_score']
-            del h['hybrid_search_info']
-            tmi['text_match'] = h['text_match']
-            del h['text_match']
-            tmi['vector_distance'] = h['vector_distance']
-            del h['vector_distance']
+        for i, h in enumerate(r['hits']):
+            tmi = h.pop('text_match_info', None) or {}
+            tmi['rank_fusion_score'] = h.pop('hybrid_search_info', {}).get('rank_fusion_score')
+            tmi['text_match'] = h.pop('text_match', None)
+            tmi['vector_distance'] = h.pop('vector_distance', None)
 
             doc = h['document']
             doc['_text_match_info'] = tmi
 
-            hits.append(doc)
+            hits[i] = doc
 
         return hits
 
-    def get_document(self, doc_id):
-        d = self.client.collections['library'].documents[doc_id].retrieve()
-        if 'embedding' in d:
-            del d['embedding']
+    # noinspection PyUnusedLocal
+    def search(self, text, tags=None, hybrid=False, ef=None):
+
+        r = self._search(text, hybrid=hybrid, ef=ef)
+
+        return self._consolidate_hits(r)
 
-        return d
+    def search_vectors(self, text, k=10, tags=None, hybrid=False, ef=None) -> SearchVectors:
+        """Like search(), but return the scores of the top k hits as numpy arrays"""
+        import numpy as np
+
+        q = self._search_query(text, tags, hybrid, ef)
+        q['per_page'] = k
+
+        hits = self._search_docs.search(q)['hits']
+        n = len(hits)
+
+        ids = np.empty(n, dtype=object)
+        # text_match scores are large integers, which float32 can't hold
+        tm = np.full(n, np.nan, dtype=np.float64)
+        vd = np.full(n, np.nan, dtype=np.float32)
+        rf = np.full(n, np.nan, dtype=np.float32)
+        docs = [None] * n
+
+        for i, h in enumerate(hits):
+            docs[i] = doc = h['document']
+            ids[i] = doc.get('id')
+            if 'text_match' in h:
+                tm[i] = h['text_match']
+            if 'vector_distance' in h:
+                vd[i] = h['vector_distance']
+            if 'hybrid_search_info' in h:
+                rf[i] = h['hybrid_search_info']['rank_fusion_score']
+
+        return SearchVectors(ids, tm, vd, rf, docs)
+
+    def multi_search(self, texts: List[str], hybrid=False, ef=None) -> List[List[dict]]:
+        """Run several searches in one request, with the multi_search API,
+        returning a list of hits for each query"""
+        searches = [dict(self._search_query(text, hybrid=hybrid, ef=ef), collection=self.collection_alias)
+                    for text in texts]
+
+        r = self.search_client.multi_search.perform({"searches": searches}, {})
+
+        return [self._consolidate_hits(e) for e in r['results']]
+
+    def _async_http(self):
+        """Return an httpx.AsyncClient for the first node of the Typesense client"""
+        import httpx
+
+        config = self.client.config
+        node = config.nodes[0]
+
+        return httpx.AsyncClient(
+            base_url=f"{node.protocol}://{node.host}:{node.port}{getattr(node, 'path', '')}",
+            headers={"X-TYPESENSE-API-KEY": config.api_key},
+            limits=httpx.Limits(max_keepalive_connections=32),
+            timeout=self.search_timeout,
+        )
+
+    async def _asearch(self, http, text, tags=None, hybrid=False, ef=None):
+        r = await http.get(f"/collections/{self.collection_alias}/documents/search",
+                           params=self._search_query(text, tags, hybrid, ef))
+        r.raise_for_status()
+
+        return self._consolidate_hits(json_loads(r.content))
+
+    async def asearch_many(self, texts: List[str], hybrid=False, ef=None) -> List[List[dict]]:
+        """Run several searches concurrently, returning a list of hits for each query"""
+        async with self._async_http() as http:
+            return list(await asyncio.gather(*[self._asearch(http, text, hybrid=hybrid, ef=ef)
+                                               for text in texts]))
+
+    async def asearch(self, text, tags=None, hybrid=False, ef=None):
+        """Async version of search()"""
+        async with self._async_http() as http:
+            return await self._asearch(http, text, tags, hybrid, ef)
+
+    def search_many(self, texts: List[str], hybrid=False, ef=None) -> List[List[dict]]:
+        """Run several searches concurrently, from synchronous code"""
+        return asyncio.run(self.asearch_many(texts, hybrid, ef))
+
+    def get_document(self, doc_id):
+        """Return a document, without its embedding. The retrieve endpoint
+        always returns the whole document, so this is a search on the id, which
+        lets the server drop the embedding before sending it"""
+        r = self._search_docs.search({"q": "*",
+                               "query_by": "title",
+                               "filter_by": f"id:={doc_id}",
+                               "exclude_fields": "embedding",
+                               "per_page": 1})
+
+        if not r['hits']:
+            raise ObjectNotFound(f"No document with id {doc_id}")
+
+        return r['hits'][0]['document']
 
 
 class TestCase(unittest.TestCase):
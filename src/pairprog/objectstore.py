@@ -2,28 +2,119 @@
 can access S3 via Boto, but also use a local filesystem
 """
 
+import asyncio
+import functools
+import gzip
+import inspect
 import json
+import os
 import pickle
 import shelve
+import struct
 import sys
+import threading
+import time
+import unittest
+from collections import OrderedDict
 from pathlib import Path, PosixPath
 
 from slugify import slugify
 
 from .config import get_config
 
+# Heavy or optional modules are imported on first use, so that users who only
+# touch the local stores don't pay for them at import time.
+_boto3 = None
+_magic = None
+_redis = None
+
+
+def _get_boto3():
+    global _boto3
+    if _boto3 is None:
+        import boto3
+
+        _boto3 = boto3
+    return _boto3
+
+
+def _get_magic():
+    global _magic
+    if _magic is None:
+        import magic
+
+        _magic = magic
+    return _magic
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        import redis
+
+        _redis = redis
+    return _redis
+
 
 def oscache(storage):
     """Cache values from a function in `storage`. Not that this does not properly
-    handle default argument, which will not be included in the key"""
+    handle default argument, which will not be included in the key.
+
+    Concurrent calls that miss on the same key are coalesced, so the function
+    is only run once; the other callers wait for the result. Coroutine
+    functions are supported, using asyncio locks."""
+
+    def _key(func, args, kwargs):
+        key = (func.__name__, args, frozenset(kwargs.items()))
+        return "oscache-" + str(key)
 
     def decorator(func):
+        # Per-key locks for keys that are being computed
+        locks = {}
+        locks_lock = threading.Lock()
+
+        def _lock_for(key, factory):
+            with locks_lock:
+                lock = locks.get(key)
+                if lock is None:
+                    lock = locks[key] = factory()
+                return lock
+
+        def _release(key):
+            with locks_lock:
+                locks.pop(key, None)
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                key = _key(func, args, kwargs)
+                if key in storage:
+                    return storage[key]
+
+                try:
+                    async with _lock_for(key, asyncio.Lock):
+                        if key not in storage:
+                            storage[key] = await func(*args, **kwargs)
+                        return storage[key]
+                finally:
+                    _release(key)
+
+            return async_wrapper
+
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            key = (func.__name__, args, frozenset(kwargs.items()))
-            key = "oscache-" + str(key)
-            if key not in storage:
-                storage[key] = func(*args, **kwargs)
-            return storage[key]
+            key = _key(func, args, kwargs)
+            if key in storage:
+                return storage[key]
+
+            try:
+                with _lock_for(key, threading.Lock):
+                    if key not in storage:
+                        storage[key] = func(*args, **kwargs)
+                    return storage[key]
+            finally:
+                _release(key)
 
         return wrapper
 
@@ -31,10 +122,8 @@ def oscache(storage):
 
 
 def get_content_type(o):
-    import magic
-
     try:
-        return magic.from_file(o, mime=True)
+        return _get_magic().from_file(o, mime=True)
     except ImportError:
         raise ImportError(
             "You probably need to install lib magic: "
@@ -42,6 +131,180 @@ def get_content_type(o):
         )
 
 
+_JSON_SCALARS = frozenset((str, int, float, bool, type(None)))
+_JSON_CONTAINERS = frozenset((list, tuple, dict))
+
+
+# Pushed after a container's children, to mark the end of its subtree
+_EXIT = object()
+
+
+def _is_json_safe(o):
+    """Return True if o is made only of types that json.dumps() can encode,
+    so objects that need pickling can skip a failed JSON encode"""
+
+    stack = [o]
+    ancestors = set()  # ids of the containers on the path to the current element
+
+    while stack:
+        e = stack.pop()
+
+        if e is _EXIT:
+            ancestors.discard(id(stack.pop()))
+            continue
+
+        t = type(e)
+
+        if t in _JSON_SCALARS:
+            continue
+        elif t not in _JSON_CONTAINERS or id(e) in ancestors:
+            # Unknown types and self-referencing containers get pickled. A
+            # container that appears twice, but not inside itself, is fine
+            return False
+
+        ancestors.add(id(e))
+        stack.append(e)
+        stack.append(_EXIT)
+
+        if t is dict:
+            for k in e:
+                if type(k) not in _JSON_SCALARS:
+                    return False
+            stack.extend(e.values())
+        else:
+            stack.extend(e)
+
+    return True
+
+
+# Trailer marker for files that have out-of-band pickle buffers appended
+_OOB_MAGIC = b"PPOOB\x00\x00\x01"
+
+
+def _load_frames(b):
+    """Unpickle the bytes of a file written by _write_pickle(). Plain pickles
+    are loaded as they are. The buffers are passed to pickle as views of `b`,
+    so pass a bytearray if the unpickled arrays should be writable."""
+
+    mv = memoryview(b)
+
+    if not mv[-len(_OOB_MAGIC) :] == _OOB_MAGIC:
+        return pickle.loads(mv)
+
+    end = len(mv) - len(_OOB_MAGIC) - 4
+    (n,) = struct.unpack_from("<I", mv, end)
+    end -= 8 * n
+    sizes = struct.unpack_from(f"<{n}Q", mv, end)
+
+    start = end - sum(sizes)
+    buffers = []
+    for size in sizes:
+        buffers.append(mv[start : start + size])
+        start += size
+
+    # pickle ignores the bytes after the end of the pickle stream
+    return pickle.loads(mv, buffers=buffers)
+
+
+def _write_pickle(file_path: Path | str, o):
+    """Pickle an object to a file with protocol 5. The pickle is streamed to
+    the file, so it is never held in memory as a whole. Large buffers, such as
+    numpy arrays, are written after the pickle stream, straight from their
+    memory, followed by a trailer with their sizes. If there are no such
+    buffers, the file is an ordinary pickle.
+
+    The pickle is written to a temporary file in the same directory and moved
+    into place when it is complete, so readers never see a partial file, and a
+    failed pickle leaves the old file, if any, as it was."""
+    dir_name, base_name = os.path.split(os.fspath(file_path))
+    tmp_path = os.path.join(dir_name, f".{base_name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    # Created with the same permissions as a file from open()
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+    try:
+        buffers = []
+
+        with open(fd, "wb", buffering=1 << 20) as f:
+            pickle.Pickler(f, protocol=5, buffer_callback=buffers.append).dump(o)
+
+            if buffers:
+                raws = [b.raw() for b in buffers]
+                for r in raws:
+                    f.write(r)
+
+                f.write(
+                    struct.pack(f"<{len(raws)}QI", *(r.nbytes for r in raws), len(raws))
+                )
+                f.write(_OOB_MAGIC)
+
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class _ByteCounter:
+    """A write-only file that counts the bytes written to it, and the
+    out-of-band buffers passed to it by pickle"""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, b):
+        n = memoryview(b).nbytes
+        self.size += n
+        return n
+
+    def add_buffer(self, buf):
+        # Returns None, so pickle leaves the buffer out of band, uncopied
+        self.size += buf.raw().nbytes
+
+
+def _stored_size(o) -> int:
+    """Return about how many bytes an object takes to store, without building
+    its serialized form in memory. Arrays report their size directly; other
+    objects are pickled into a counter, with large buffers left out of band."""
+    if isinstance(o, (bytes, bytearray, memoryview)):
+        return memoryview(o).nbytes
+    elif isinstance(o, str):
+        return len(o)
+
+    nbytes = getattr(o, "nbytes", None)
+    if isinstance(nbytes, int):  # numpy arrays
+        return nbytes
+
+    counter = _ByteCounter()
+    pickle.Pickler(counter, protocol=5, buffer_callback=counter.add_buffer).dump(o)
+    return counter.size
+
+
+def _read_pickle(file_path: Path | str):
+    """Read an object written by _write_pickle() or by plain pickle"""
+    with open(file_path, "rb", buffering=1 << 20) as f:
+        size = os.fstat(f.fileno()).st_size
+
+        if size > len(_OOB_MAGIC):
+            f.seek(size - len(_OOB_MAGIC))
+            has_buffers = f.read() == _OOB_MAGIC
+            f.seek(0)
+        else:
+            has_buffers = False
+
+        if not has_buffers:
+            # Stream the unpickling from the file
+            return pickle.load(f)
+
+        b = bytearray(size)
+        f.readinto(b)
+
+    return _load_frames(b)
+
+
+@functools.singledispatch
 def _to_bytes(o):
     """Convert an object to bytes, and return:
     - the type code
@@ -56,24 +319,12 @@ def _to_bytes(o):
     sets and objects. Scalars are converted to strings. Objects are serialized
     to JSON, if possible, or pickled if not. If the object is a Path or has a read()
     method, the contents of the file are returned.
-    """
 
-    if isinstance(o, PosixPath):
-        # Put data from a file
-        content_type = get_content_type(o)
-        b = o.read_bytes()
-        return b, len(b), content_type, ""  # "application/octet-stream", ""
-
-    elif isinstance(o, str):
-        # A normal string, so encode it
-        size = len(o)
-        b = o.encode("utf8")
-        return b, size, "text/plain; charset=utf-8", ""
-
-    elif isinstance(o, bytes):
-        return o, len(o), "application/octet-stream", ""
+    Dispatch is on the type of the object; this base implementation handles
+    file-like objects and the JSON / pickle fallback.
+    """
 
-    elif hasattr(o, "read"):
+    if hasattr(o, "read"):
         try:
             size = o.getbuffer().nbytes
             return o, size, "application/octet-stream", ""
@@ -81,19 +332,36 @@ def _to_bytes(o):
             # Nope, not a buffer
             return _to_bytes(o.read())
 
-    elif isinstance(o, object):
-        try:
-            o = json.dumps(o).encode("utf8")
-            size = len(o)
-            return o, size, "application/json", ""
+    elif _is_json_safe(o):
+        o = json.dumps(o).encode("utf8")
+        size = len(o)
+        return o, size, "application/json", ""
+
+    else:  # Can't be serialized with JSON
+        o = pickle.dumps(o, protocol=pickle.HIGHEST_PROTOCOL)
+        size = len(o)
+        return o, size, "application/x-pickle", ""
 
-        except TypeError:  # Probably can't be serialized with JSON
-            o = pickle.dumps(o)
-            size = len(o)
-            return o, size, "application/x-pickle", ""
 
-    else:
-        raise IOError("Can't understand how to use object")
+@_to_bytes.register
+def _(o: PosixPath):
+    # Put data from a file
+    content_type = get_content_type(o)
+    b = o.read_bytes()
+    return b, len(b), content_type, ""  # "application/octet-stream", ""
+
+
+@_to_bytes.register
+def _(o: str):
+    # A normal string, so encode it
+    size = len(o)
+    b = o.encode("utf8")
+    return b, size, "text/plain; charset=utf-8", ""
+
+
+@_to_bytes.register
+def _(o: bytes):
+    return o, len(o), "application/octet-stream", ""
 
 
 def new_object_store(**kwargs):
@@ -311,9 +579,17 @@ class S3ObjectStore(_ObjectStore):
         endpoint: str = None,
         region: str = None,
         client=None,
+        pool_size: int = 64,
         **kwargs,
     ):
-        import boto3
+        """
+        :param pool_size: Maximum number of pooled HTTP connections for the client,
+            which limits how many requests can be in flight at once. The AWS CRT
+            transport can be used by installing `boto3[crt]`, and is
+            enabled with the AWS_CRT_CLIENT environment variable.
+        """
+        boto3 = _get_boto3()
+        from botocore.config import Config
 
         super().__init__(bucket=bucket, prefix=prefix, **kwargs)
 
@@ -344,10 +620,19 @@ class S3ObjectStore(_ObjectStore):
             else:
                 self.session = boto3.session.Session()
 
+            client_config = Config(
+                max_pool_connections=pool_size,
+                retries={"mode": "adaptive", "max_attempts": 5},
+                tcp_keepalive=True,
+                # Over HTTPS, skip hashing the body of every put
+                s3={"payload_signing_enabled": False},
+            )
+
             self.client = self.session.client(
                 "s3",
                 aws_access_key_id=self.access_key,
                 aws_secret_access_key=self.secret_key,
+                config=client_config,
                 **config,
             )
         else:
@@ -427,13 +712,9 @@ class S3ObjectStore(_ObjectStore):
                 r.get("ContentType") == "application/x-gzip"
                 or r.get("ContentEncoding") == "gzip"
             ):
-                import gzip
-
-                return gzip.decompress(r.read())
+                return gzip.decompress(body.read())
             if r.get("ContentType") == "application/octet-stream":
                 if key.endswith(".gz"):
-                    import gzip
-
                     return gzip.decompress(body.read())
                 else:
                     return body.read()
@@ -464,7 +745,8 @@ class S3ObjectStore(_ObjectStore):
     def delete(self, key: str):
         self.client.delete_object(Bucket=self.bucket, Key=self.join_path(key))
 
-    def list(self, prefix: str = "", recursive=True):
+    def _paginate(self, prefix: str = ""):
+        """Return the S3 key prefix and a PageIterator over the objects in it"""
         # Create a reusable Paginator
         paginator = self.client.get_paginator("list_objects")
 
@@ -477,7 +759,44 @@ class S3ObjectStore(_ObjectStore):
         elif not prefix.endswith("/"):
             prefix = prefix + "/"
 
-        itr = paginator.paginate(Bucket=self.bucket, Prefix=prefix)
+        return prefix, paginator.paginate(Bucket=self.bucket, Prefix=prefix)
+
+    def _delete_keys(self, keys: list):
+        r = self.client.delete_objects(
+            Bucket=self.bucket,
+            Delete={"Objects": [{"Key": k} for k in keys], "Quiet": True},
+        )
+
+        if r.get("Errors"):
+            e = r["Errors"][0]
+            raise IOError(
+                f"Failed to delete {len(r['Errors'])} objects from {self.bucket}; "
+                + f"first error: {e.get('Key')}: {e.get('Message')}"
+            )
+
+        return len(keys)
+
+    def delete_prefix(self, prefix: str = "", workers: int = 4) -> int:
+        """Delete all of the objects under a prefix, using a bulk delete request
+        for each page of up to 1000 keys. Pages are deleted concurrently
+        by `workers` threads. Returns the number of objects deleted."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        prefix, itr = self._paginate(prefix)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for page in itr:
+                # A page has at most 1000 keys, which is also the limit for
+                # delete_objects
+                keys = [e["Key"] for e in page.get("Contents", [])]
+                if keys:
+                    futures.append(executor.submit(self._delete_keys, keys))
+
+            return sum(f.result() for f in futures)
+
+    def list(self, prefix: str = "", recursive=True):
+        prefix, itr = self._paginate(prefix)
 
         try:
             for page in itr:
@@ -568,20 +887,22 @@ class LocalLargeObjectStore(LocalObjectStore):
     def put(self, key: str, data: bytes):
         """Store data in the file system, and store a reference to the file in the shelve database"""
 
-        b, size, content_type, ext = _to_bytes(data)
-
-        if size > 1024 * 1024 * 10:
-            # If the file is large, store it in the file system
+        if _stored_size(data) > 1024 * 1024 * 10:
+            # If the file is large, store it in the file system. _write_pickle
+            # streams it to a temp file, with arrays written out of band, so
+            # the pickle is never held in memory
             file_path = Path(self.path).joinpath(slugify(key))
 
             if not file_path.parent.exists():
                 file_path.parent.mkdir(parents=True)
 
-            # pickle the data to the file
-            file_path.write_bytes(pickle.dumps(data))
+            _write_pickle(file_path, data)
 
+            # Store a reference to the file in the shelve database
             data = file_path
 
+        super().put(key, data)
+
     def get(self, key: str) -> bytes:
         """Get data from the file system, or from the shelve database"""
 
@@ -589,7 +910,7 @@ class LocalLargeObjectStore(LocalObjectStore):
 
         if isinstance(o, PosixPath):
             # unpickle
-            return pickle.loads(o.read_bytes())
+            return _read_pickle(o)
 
         else:
             return o
@@ -620,36 +941,41 @@ class FSObjectStore(LocalObjectStore):
         if not path.exists():
             path.mkdir(parents=True)
 
-        self.path = str(path / self.bucket)
+        self._base = path / self.bucket
+        self.path = str(self._base)
 
     def _file_path(self, key):
-        return Path(self.path).joinpath(key)
+        return self._base / key
+
+    def _file_path_str(self, key):
+        # Plain string paths avoid building Path objects on the hot paths
+        return os.path.join(self.path, key)
 
     def put(self, key: str, data: bytes):
         # If the file is large, store it in the file system
-        file_path = self._file_path(key)
-
-        if not file_path.parent.exists():
-            file_path.parent.mkdir(parents=True)
+        file_path = self._file_path_str(key)
 
-        # pickle the data to the file
-        file_path.write_bytes(pickle.dumps(data))
+        try:
+            _write_pickle(file_path, data)
+        except FileNotFoundError:
+            # First write into this directory
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            _write_pickle(file_path, data)
 
     def get(self, key: str) -> bytes:
-        if not self.exists(key):
+        try:
+            return _read_pickle(self._file_path_str(key))
+        except FileNotFoundError:
             raise KeyError(f"No such key {key} in bucket {self.bucket}")
 
-        file_path = self._file_path(key)
-        return pickle.loads(file_path.read_bytes())
-
     def exists(self, key: str) -> bool:
-        return self._file_path(key).exists()
+        return os.path.exists(self._file_path_str(key))
 
     def delete(self, key: str):
-        return self._file_path(key).unlink()
+        return os.unlink(self._file_path_str(key))
 
     def list(self, prefix: str = "", recursive=True) -> list:
-        path = Path(self.path)
+        path = self._base
 
         for file_path in path.joinpath(prefix).glob("**/*"):
             yield str(file_path.relative_to(path))
@@ -658,11 +984,54 @@ class FSObjectStore(LocalObjectStore):
         return f"{self.__class__.__name__}({self.path}; {self.bucket}; {self.prefix})"
 
 
+class LocalCache:
+    """A small, thread-safe, in-process LRU cache with a time-to-live on each entry"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
 redis_pools = dict()
 
 
 def connect_redis(url):
-    import redis
+    redis = _get_redis()
 
     if url not in redis_pools:
         redis_pools[url] = redis.ConnectionPool.from_url(url)
@@ -680,8 +1049,18 @@ class RedisObjectStore(_ObjectStore):
         prefix: str = None,
         url: str = None,
         client=None,
+        local_cache_size: int = 0,
+        local_cache_ttl: float = 60,
         **kwargs,
     ):
+        """
+        :param local_cache_size: If non-zero, keep up to this many values from
+            get() in an in-process LRU cache, so repeated reads of hot keys don't
+            go to the server. The cache holds the pickled values, and each get()
+            unpickles a new copy. Writes from other processes are not seen until
+            the local entry expires.
+        :param local_cache_ttl: Seconds a value stays in the local cache
+        """
         self.url = url
         self.bucket = bucket
         self.prefix = prefix
@@ -691,6 +1070,14 @@ class RedisObjectStore(_ObjectStore):
         else:
             self.client = client
 
+        self.local_cache_size = local_cache_size
+        self.local_cache_ttl = local_cache_ttl
+
+        if local_cache_size:
+            self.local_cache = LocalCache(local_cache_size, local_cache_ttl)
+        else:
+            self.local_cache = None
+
     def sub(self, *args, **kwargs):
         if "name" in kwargs or "class_" in kwargs:
             # We are changing the type, so don't keep the client
@@ -701,25 +1088,59 @@ class RedisObjectStore(_ObjectStore):
                 prefix=self.prefix if not args else self.join_path(*args),
                 url=self.url,
                 client=self.client,
+                local_cache_size=self.local_cache_size,
+                local_cache_ttl=self.local_cache_ttl,
             )
 
     def put(self, key: str, data: bytes):
-        return self.client.set(self.join_pathb(key), pickle.dumps(data))
+        key = self.join_pathb(key)
+
+        if self.local_cache is not None:
+            self.local_cache.pop(key)
+
+        return self.client.set(
+            key, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        )
 
     def setex(self, key: str, data: bytes, ttl: int):
-        return self.client.setex(self.join_pathb(key), ttl, pickle.dumps(data))
+        key = self.join_pathb(key)
+
+        if self.local_cache is not None:
+            self.local_cache.pop(key)
+
+        return self.client.setex(
+            key,
+            ttl,
+            pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL),
+        )
 
     def get(self, key: str) -> bytes:
-        d = self.client.get(self.join_pathb(key))
+        bkey = self.join_pathb(key)
+
+        # The local cache holds the pickled bytes, not the object, so each
+        # get() returns a fresh copy that callers can modify
+        d = self.local_cache.get(bkey) if self.local_cache is not None else None
+
         if d is None:
-            raise KeyError(f"No such key {key} in bucket {self.bucket}")
+            d = self.client.get(bkey)
+            if d is None:
+                raise KeyError(f"No such key {key} in bucket {self.bucket}")
+
+            if self.local_cache is not None:
+                self.local_cache.put(bkey, d)
+
         return pickle.loads(d)
 
     def exists(self, key: str) -> bool:
         return self.client.exists(self.join_pathb(key))
 
     def delete(self, key: str):
-        self.client.delete(self.join_pathb(key))
+        key = self.join_pathb(key)
+
+        if self.local_cache is not None:
+            self.local_cache.pop(key)
+
+        self.client.delete(key)
 
     # Object Handlers
 
@@ -1022,3 +1443,109 @@ def resolve_cache(cache_config):
         return ObjectStore.new(**cache_config)
     else:
         return cache_config
+
+
+class TestCase(unittest.TestCase):
+
+    def test_pickle_files(self):
+        import tempfile
+
+        import numpy as np
+
+        with tempfile.TemporaryDirectory() as d:
+            # Without large buffers, the file is an ordinary pickle
+            p = os.path.join(d, "plain")
+            _write_pickle(p, {"a": [1, 2], "b": "three"})
+            self.assertEqual(_read_pickle(p), {"a": [1, 2], "b": "three"})
+            with open(p, "rb") as f:
+                self.assertEqual(pickle.load(f), {"a": [1, 2], "b": "three"})
+
+            # Arrays are written out of band, after the pickle stream
+            p = os.path.join(d, "oob")
+            a = np.arange(100_000, dtype="float64")
+            _write_pickle(p, {"a": a, "b": "three"})
+            self.assertTrue(Path(p).read_bytes().endswith(_OOB_MAGIC))
+
+            o = _read_pickle(p)
+            self.assertTrue(np.array_equal(o["a"], a))
+            self.assertEqual(o["b"], "three")
+            o["a"][0] = 1.0  # The loaded arrays are writable
+
+            # Files written by plain pickle, before the trailer format
+            p = os.path.join(d, "legacy")
+            with open(p, "wb") as f:
+                pickle.dump([1, "two", {"three": 3.0}], f, protocol=4)
+            self.assertEqual(_read_pickle(p), [1, "two", {"three": 3.0}])
+
+            self.assertEqual(sorted(os.listdir(d)), ["legacy", "oob", "plain"])
+
+    def test_failed_put(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            fs = FSObjectStore(bucket="test", path=d)
+            fs["k"] = "old"
+
+            # A failed put leaves the old value, and no partial file for a new key
+            with self.assertRaises(TypeError):
+                fs["k"] = threading.Lock()
+            self.assertEqual(fs["k"], "old")
+
+            with self.assertRaises(TypeError):
+                fs["new"] = threading.Lock()
+            self.assertFalse(fs.exists("new"))
+            with self.assertRaises(KeyError):
+                fs["new"]
+
+            self.assertEqual(list(fs.list()), ["k"])
+
+    def test_oscache_coalescing(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        calls = []
+
+        @oscache({})
+        def slow(x):
+            calls.append(x)
+            time.sleep(0.2)
+            return x * 2
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(slow, [3] * 8))
+
+        self.assertEqual(results, [6] * 8)
+        self.assertEqual(calls, [3])
+
+        async_calls = []
+
+        @oscache({})
+        async def aslow(x):
+            async_calls.append(x)
+            await asyncio.sleep(0.1)
+            return x + 1
+
+        async def run():
+            return await asyncio.gather(*[aslow(1) for _ in range(5)])
+
+        self.assertEqual(asyncio.run(run()), [2] * 5)
+        self.assertEqual(async_calls, [1])
+
+    def test_is_json_safe(self):
+        self.assertTrue(_is_json_safe("a"))
+        self.assertTrue(_is_json_safe(None))
+        self.assertTrue(_is_json_safe({"a": [1, 2.0, True, None], "b": ("c", {"d": "e"})}))
+        self.assertTrue(_is_json_safe({1: "int keys are converted"}))
+
+        self.assertFalse(_is_json_safe({1, 2}))
+        self.assertFalse(_is_json_safe({(1, 2): "tuple key"}))
+        self.assertFalse(_is_json_safe([1, b"bytes"]))
+        self.assertFalse(_is_json_safe(OrderedDict(a=1)))  # Subclasses are pickled
+
+        loop = []
+        loop.append(loop)
+        self.assertFalse(_is_json_safe(loop))
+
+        # Shared, but not cyclic, containers are fine
+        x = [1]
+        self.assertTrue(_is_json_safe([x, x]))
+        self.assertTrue(_is_json_safe({"a": x, "b": {"c": x}}))
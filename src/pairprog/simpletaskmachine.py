@@ -17,14 +17,15 @@ def compile_spec(spec: dict):
 
 import logging
 import unittest
+from collections import deque
 from pathlib import Path
-from typing import List
+from typing import ClassVar, Deque, Dict, FrozenSet, List
 
 from colored import Fore, Back, Style
 from typesense import Client
 
 from pairprog.objectstore import ObjectStore
-from pairprog.util import generate_tools_specification
+from pairprog.util import parse_template, render_template, tools_specification
 from .tool import Tool, PPTools
 
 logger = logging.getLogger(__name__)
@@ -52,12 +53,29 @@ class StepState:
     step_type = 'NA'
     step_type_description = "NA"
 
+    # The system message template, with double curly braces collapsed, ready
+    # for format(). Set for each subclass when it is defined.
+    TEMPLATE: ClassVar[str] = ''
+    _parsed_template: ClassVar[tuple] = ()
+
+    tool_methods = ()  # Names of the tools available in this state
+    tool_methods_set = frozenset()
+
     def __init__(self, manager):
         self.manager = manager
 
-    def system_message_templ(self):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        cls.tool_methods_set = frozenset(cls.tool_methods)
+
+        cls.TEMPLATE = (cls.system_message_templ() or '').replace('{{', '{').replace('}}', '}')
+        cls._parsed_template = parse_template(cls.TEMPLATE)
+
+    @classmethod
+    def system_message_templ(cls):
         """Add a message to the task history"""
-        return self.__class__.__doc__
+        return cls.__doc__
 
 
 class StartTaskState(StepState):
@@ -96,7 +114,7 @@ To recap: follow these steps to complete a task:
 
 """
 
-    tool_methods = ['start_task']
+    tool_methods = ('start_task',)
 
 
 class ExecuteStepState(StepState):
@@ -122,7 +140,7 @@ task finished with the task_complete tool:
 """
     step_type = 'NA'
     step_type_description = "NA"
-    tool_methods = ['task_complete']
+    tool_methods = ('task_complete',)
 
 
 
@@ -139,20 +157,34 @@ class TaskManager(PPTools):
     step_type: str = None  # The type of step, only used in execution steps
     step_type_description: str = None
 
-    step_instructions: List[str] = ['']  # The history of detailed step instructions
+    step_instructions: Deque[str] = None  # The recent history of detailed step instructions
 
     messages: List[dict | object] = None  # The history of messages
 
     current_state: "TaskManagerTool" = None
 
+    # The tool groups that start_task() can select from
+    TOOL_SETS: ClassVar[Dict[str, FrozenSet[str]]] = {
+        'execute': frozenset(['execute_code', 'execute_shell', 'read_file', 'write_file', 'read_library',
+                              'write_library']),
+        'research': frozenset(['web_search', 'read_library', 'write_library', 'read_wikipedia', 'store_document',
+                               'read_document'])
+    }
+
     def __init__(self, typesense_client: Client, object_store: ObjectStore, working_dir: Path) -> None:
         super().__init__(typesense_client, object_store, working_dir)
 
+        self._states = {}  # State instances, by class, reused across transitions
+
+        # Only the last instruction is used, so keep a bounded history
+        self.step_instructions = deque([''], maxlen=32)
+        self.messages = []
+
         self.next_state(StartTaskState)
 
     def system_message(self):
         """Add a message to the task history"""
-        templ = self.current_state.system_message_templ()
+        templ = self.current_state._parsed_template
 
         if self.step_instructions and self.step_instructions[-1]:
             nfls = self.step_instructions[-1]
@@ -161,11 +193,8 @@ class TaskManager(PPTools):
             nfls = ''
             notes_from_last_step = ''
 
-        # repalce any double curly braces with single curly braces
-
-        templ = templ.replace('{{', '{').replace('}}', '}')
-
-        sm = templ.format(
+        sm = render_template(
+            templ,
             task_analysis=self.task_analysis,
             plan=self.plan,
             notes_from_last_step=notes_from_last_step,
@@ -175,30 +204,36 @@ class TaskManager(PPTools):
             solution=self.solution
         )
 
-        logger.info(log_system(sm))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(log_system(sm))
 
         return sm
 
     def specification(self):
         """Return the specification for the tools available in this class."""
-        spec = generate_tools_specification(self.__class__,
-                                            include_methods=self.current_state.tool_methods)
+        # tools_specification() is cached on the class and the method names
+        spec = tools_specification(self.__class__, include_methods=self.current_state.tool_methods)
 
-        logger.info(log_spec(f"Specification: {compile_spec(spec)}"))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(log_spec(f"Specification: {compile_spec(spec)}"))
 
         return spec
 
     def next_state(self, state: type):
         """Start the next step"""
 
-        # if the state is a class, instantiate it
+        # if the state is a class, use this manager's instance of it. States
+        # only hold a reference to the manager, so one of each is enough
         if isinstance(state, type):
-            state = state(self)
+            if state not in self._states:
+                self._states[state] = state(self)
+            state = self._states[state]
 
         self.current_state = state
-        self.include_methods = state.tool_methods
+        self.include_methods = state.tool_methods_set
 
-        logger.info(log_state(f"Next state: {state.__class__.__name__}"))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(log_state(f"Next state: {state.__class__.__name__}"))
 
 
     def start_task(self, analysis: str, plan: str, tools: list[str]):
@@ -217,22 +252,18 @@ class TaskManager(PPTools):
             None
         """
 
-        tool_sets = {
-            'execute': ['execute_code', 'execute_shell', 'read_file', 'write_file', 'read_library', 'write_library'],
-            'research': ['web_search', 'read_library', 'write_library', 'read_wikipedia', 'store_document','read_document']
-        }
-
-        tools = [t for t in tools if t in tool_sets.keys()]
+        tools = list(set(tools) & self.TOOL_SETS.keys())
 
         if not tools:
             raise ValueError(f"You must select some tool groups: {tools}")
 
         self.task_analysis = analysis
-        self.include_methods = list(set(tools))
+        self.include_methods = tools
         self.plan = plan
         self.next_state(ExecuteStepState)
 
-        logger.info(log_tool(f"Start Task:\nAnalysis: {analysis}\nPlan: {plan}\nTools: {self.include_methods}"))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(log_tool(f"Start Task:\nAnalysis: {analysis}\nPlan: {plan}\nTools: {self.include_methods}"))
 
     def task_complete(self):
         """Mark the current task complete,
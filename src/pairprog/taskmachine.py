@@ -18,14 +18,15 @@ def compile_spec(spec: dict):
 
 import logging
 import unittest
+from collections import deque
 from pathlib import Path
-from typing import List
+from typing import ClassVar, Deque, List
 
 from colored import Fore, Back, Style
 from typesense import Client
 
 from pairprog.objectstore import ObjectStore
-from pairprog.util import generate_tools_specification
+from pairprog.util import parse_template, render_template, tools_specification
 from .tool import Tool, PPTools
 
 logger = logging.getLogger(__name__)
@@ -51,12 +52,29 @@ class StepState:
     step_type = 'NA'
     step_type_description = "NA"
 
+    # The system message template, with double curly braces collapsed, ready
+    # for format(). Set for each subclass when it is defined.
+    TEMPLATE: ClassVar[str] = ''
+    _parsed_template: ClassVar[tuple] = ()
+
+    tool_methods = ()  # Names of the tools available in this state
+    tool_methods_set = frozenset()
+
     def __init__(self, manager):
         self.manager = manager
 
-    def system_message_templ(self):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        cls.tool_methods_set = frozenset(cls.tool_methods)
+
+        cls.TEMPLATE = (cls.system_message_templ() or '').replace('{{', '{').replace('}}', '}')
+        cls._parsed_template = parse_template(cls.TEMPLATE)
+
+    @classmethod
+    def system_message_templ(cls):
         """Add a message to the task history"""
-        return self.__class__.__doc__
+        return cls.__doc__
 
 
 class StartTaskState(StepState):
@@ -75,7 +93,7 @@ plan by calling the start_task tool:
     start_task(analysis='< analysis of the task>', plan='<plan>')
 """
 
-    tool_methods = ['start_task']
+    tool_methods = ('start_task',)
 
 class PlanStepState(StepState):
     """You are an executive assistant working on executing a plan. You are
@@ -121,7 +139,7 @@ Then, you will start working on the next step by running the next_step tool:
     next_step(category='<next step category>', detailed_instructions='<detailed task instructions>')
 """
 
-    tool_methods = ['next_step']
+    tool_methods = ('next_step',)
 
 
 class ExecuteStepState(StepState):
@@ -162,17 +180,21 @@ or `reason` arguments, because you will use those notes to complete the next ste
 """
     step_type = 'NA'
     step_type_description = "NA"
-    tool_methods = ['step_complete', 'step_failed']
+    tool_methods = ('step_complete', 'step_failed')
 
     step_complete_example = "step_complete(use_note='<notes on how to use the output>', updated_plan='<updated plan>')"
 
-    def system_message_templ(self):
+    # The template for all execution steps, which subclasses fill in with their own details
+    step_template = __doc__
+
+    @classmethod
+    def system_message_templ(cls):
         """Add a message to the task history"""
-        return ExecuteStepState.__doc__.format(
-            step_type=self.step_type,
-            step_type_description=self.step_type_description,
-            step_details=self.__class__.__doc__,
-            step_complete_example=self.step_complete_example
+        return cls.step_template.format(
+            step_type=cls.step_type,
+            step_type_description=cls.step_type_description,
+            step_details=cls.__doc__,
+            step_complete_example=cls.step_complete_example
         )
 
 
@@ -186,7 +208,7 @@ also perform some basic file system operations. """
     step_type_description = "executing python code or running a shell command"
 
     tool_methods = ExecuteStepState.tool_methods + \
-                   ['execute_code', 'shell', 'read_file', 'write_file']
+                   ('execute_code', 'shell', 'read_file', 'write_file')
 
 
 class ResearchState(ExecuteStepState):
@@ -210,8 +232,8 @@ Then you can search the document with search_documents.
     step_type_description = "web search, reading documents, writing documents"
 
     tool_methods = ExecuteStepState.tool_methods + \
-                   ['web_search', 'read_file', 'write_file', 'store_document', 'search_documents',
-                    'wikipedia_search']
+                   ('web_search', 'read_file', 'write_file', 'store_document', 'search_documents',
+                    'wikipedia_search')
 
 
 class AnalysisState(ExecuteStepState):
@@ -228,7 +250,7 @@ When you are done with the analysis, you will write yourself a note to describe
     step_complete_example = "task_solved(use_note='<notes on how to use the output>', solution='<task_solution>')"
 
     tool_methods = ExecuteStepState.tool_methods + \
-                   ['read_file', 'search_documents']
+                   ('read_file', 'search_documents')
 
 
 class EvaluateState(ExecuteStepState):
@@ -264,7 +286,7 @@ tell the user what the solution is, then call the task_done() tool:
     step_type_description = "assessing the quality of your response and determining if you have satisfied the user's request"
 
     tool_methods = ExecuteStepState.tool_methods + \
-                   ['read_file', 'search_documents']
+                   ('read_file', 'search_documents')
 
 
 class TaskManager(PPTools):
@@ -280,7 +302,7 @@ class TaskManager(PPTools):
     step_type: str = None  # The type of step, only used in execution steps
     step_type_description: str = None
 
-    step_instructions: List[str] = ['']  # The history of detailed step instructions
+    step_instructions: Deque[str] = None  # The recent history of detailed step instructions
 
     messages: List[dict | object] = None  # The history of messages
 
@@ -289,11 +311,17 @@ class TaskManager(PPTools):
     def __init__(self, typesense_client: Client, object_store: ObjectStore, working_dir: Path) -> None:
         super().__init__(typesense_client, object_store, working_dir)
 
+        self._states = {}  # State instances, by class, reused across transitions
+
+        # Only the last instruction is used, so keep a bounded history
+        self.step_instructions = deque([''], maxlen=32)
+        self.messages = []
+
         self.next_state(StartTaskState)
 
     def system_message(self):
         """Add a message to the task history"""
-        templ = self.current_state.system_message_templ()
+        templ = self.current_state._parsed_template
 
         if self.step_instructions and self.step_instructions[-1]:
             nfls = self.step_instructions[-1]
@@ -302,11 +330,8 @@ class TaskManager(PPTools):
             nfls = ''
             notes_from_last_step = ''
 
-        # repalce any double curly braces with single curly braces
-
-        templ = templ.replace('{{', '{').replace('}}', '}')
-
-        sm = templ.format(
+        sm = render_template(
+            templ,
             task_analysis=self.task_analysis,
             plan=self.plan,
             notes_from_last_step=notes_from_last_step,
@@ -316,30 +341,36 @@ class TaskManager(PPTools):
             solution=self.solution
         )
 
-        logger.info(log_system(sm))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(log_system(sm))
 
         return sm
 
     def specification(self):
         """Return the specification for the tools available in this class."""
-        spec = generate_tools_specification(self.__class__,
-                                            include_methods=self.current_state.tool_methods)
+        # tools_specification() is cached on the class and the method names
+        spec = tools_specification(self.__class__, include_methods=self.current_state.tool_methods)
 
-        logger.info(log_spec(f"Specification: {compile_spec(spec)}"))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(log_spec(f"Specification: {compile_spec(spec)}"))
 
         return spec
 
     def next_state(self, state: type):
         """Start the next step"""
 
-        # if the state is a class, instantiate it
+        # if the state is a class, use this manager's instance of it. States
+        # only hold a reference to the manager, so one of each is enough
         if isinstance(state, type):
-            state = state(self)
+            if state not in self._states:
+                self._states[state] = state(self)
+            state = self._states[state]
 
         self.current_state = state
-        self.include_methods = state.tool_methods
+        self.include_methods = state.tool_methods_set
 
-        logger.info(log_state(f"Next state: {state.__class__.__name__}"))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(log_state(f"Next state: {state.__class__.__name__}"))
 
     next_steps = {
         'execution': CodeCommandState,
@@ -2,12 +2,15 @@ import enum
 import json
 import logging
 import os
+import re
+import shlex
 import subprocess
+import threading
 import unittest
+import functools
 from functools import cached_property
 
 import typesense
-import wikipedia
 from typesense import Client
 
 from pairprog.filesystem import FSAccess
@@ -18,6 +21,10 @@ from .util import *
 
 logger = logging.getLogger(__name__)
 
+# Characters that need /bin/sh to interpret them: pipes, redirection, globs,
+# expansions, escapes, comments and variable assignments.
+_SHELL_META = re.compile(r"[|&;<>()$`\\*?\[\]{}~#=!\n]")
+
 
 class TaskState(enum.Enum):
     NONE = 1
@@ -40,19 +47,43 @@ class Tool:
         self.session_cache = None
         self.iteration_id = None
         self.assistant = None
+        self._tool_dispatch = {}  # Bound tool methods, by name
 
     def specification(self):
         """Return the specification for the tools available in this class."""
-        return generate_tools_specification(self.__class__)
+        return tools_specification(self.__class__)
 
     def set_working_dir(self, working_directory):
-        self.wd = Path(working_directory)
-        # Change the working directory
-        os.chdir(self.wd)
+        # The directory is passed to the things that need it, rather than
+        # changing the process's working directory, which other tool instances share
+        self.wd = Path(working_directory) if working_directory else Path.cwd()
 
     def set_assistant(self, assistant):
         self.assistant = assistant
 
+    def set_session_cache(self, cache: ObjectStore):
+        """Set an object store for tools to cache results in"""
+        self.session_cache = cache
+
+    @cached_property
+    def _cache_writer(self):
+        """A single thread for session cache writes, so they stay in order"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-cache')
+
+    def _cache_put(self, key: str, value):
+        """Write to the session cache in the background. The cache may be a
+        remote object store, and tools don't need to wait for the write"""
+
+        def put():
+            try:
+                self.session_cache.put(key, value)
+            except Exception as e:
+                logger.warning("Failed to write %s to the session cache: %s", key, e)
+
+        self._cache_writer.submit(put)
+
     def run_tool(self, name, args):
 
         if name in self.exclude_methods:
@@ -61,13 +92,18 @@ class Tool:
         if self.include_methods and name not in self.include_methods:
             raise NotImplementedError(f"Method {name} is not available ( it is not included)")
 
-        f = getattr(self, name)
         try:
-            args = json.loads(args)
-        except TypeError:
-            pass
-        except json.JSONDecodeError as e:
-            raise ValueError(f"Bad arguments: {args} ( They should be valid JSON )")
+            f = self._tool_dispatch[name]
+        except KeyError:
+            f = self._tool_dispatch[name] = getattr(self, name)
+
+        # The assistant passes the JSON from the model; callers in code may
+        # pass a dict
+        if isinstance(args, (str, bytes)):
+            try:
+                args = loads(args)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Bad arguments: {args} ( They should be valid JSON )")
 
         if not isinstance(args, dict):
             raise ValueError(f"Arguments must be a dictionary, not {type(args)}")
@@ -89,7 +125,16 @@ class PPTools(Tool):
     def __init__(self,
                  typesense_client: Client,
 
-                 working_dir: Path) -> None:
+                 working_dir: Path,
+                 *,
+                 prewarm: bool = False) -> None:
+        """
+        Args:
+            typesense_client (Client): Client for the document library.
+            working_dir (Path): Directory for the shell, the IPython kernel and file access.
+            prewarm (bool): Start the IPython kernel in a background thread now,
+                rather than on the first call to execute_python().
+        """
 
         super().__init__(working_dir)
 
@@ -97,6 +142,30 @@ class PPTools(Tool):
 
         self.fs = FSAccess(self.wd)
 
+        # Set once the kernel may be started or used from the calling thread
+        self._ipy_ready = threading.Event()
+
+        # Guards kernel creation, since execute_python() can stop waiting on
+        # the prewarm thread while it is still starting the kernel
+        self._ipy_lock = threading.Lock()
+        self._ipy = None
+
+        if prewarm:
+            threading.Thread(target=self._prewarm, name='pptools-prewarm', daemon=True).start()
+        else:
+            self._ipy_ready.set()
+
+    def _prewarm(self):
+        """Start the IPython kernel while the assistant is waiting on the model
+        for its first response"""
+        try:
+            self.ipy
+        except Exception as e:
+            # execute_python() will try again, and report the error
+            logger.warning("Failed to prewarm the IPython kernel: %s", e)
+        finally:
+            self._ipy_ready.set()
+
     def system_message(self):
         from pairprog.util import get_prompt
 
@@ -104,18 +173,34 @@ class PPTools(Tool):
         # logger.info(log_system(sm))
         return sm
 
-    @cached_property
+    @property
     def ipy(self) -> IpyKernel:
         """An instance of IPython kernel."""
-        ipy = IpyKernel()
-        ipy.start()
-        return ipy
+        with self._ipy_lock:
+            if self._ipy is None:
+                ipy = IpyKernel()
+                ipy.start(cwd=self.wd)
+                self._ipy = ipy
+            return self._ipy
+
+    @cached_property
+    def _ddgs(self):
+        """A DuckDuckGo search client, reused so searches share its session"""
+        from duckduckgo_search import DDGS
+
+        return DDGS()
 
     @cached_property
     def library(self) -> Library:
         """A text search engine."""
         return Library(self.ts_client)
 
+    @cached_property
+    def _search_library(self):
+        """Library.search, caching the results for recent queries, since
+        search_documents() is called with the same query for each result"""
+        return functools.lru_cache(maxsize=128)(self.library.search)
+
     def execute_python(self, code: str) -> Any:
         """Execute python code using the IPython kernel.
 
@@ -132,6 +217,8 @@ class PPTools(Tool):
             the result for scalar values, or jump JSON for more complex values.
 
         """
+        self._ipy_ready.wait(timeout=30)
+
         try:
             mid, o = self.ipy.exec(code)
             v = self.ipy.get_var('_')
@@ -161,21 +248,40 @@ class PPTools(Tool):
             command (str): The command to run.
         """
 
-        process = subprocess.Popen(
-            command,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            # text=True
-        )
-
-        # Wait for the command to complete
-        stdout, stderr = process.communicate()
-
-        # Combine stdout and stderr
-        output = stdout + stderr
-
-        return output.decode('utf-8', 'replace')
+        # Simple commands are executed directly, without starting a shell to
+        # parse them. Anything the shell has to interpret, and anything that
+        # is not an executable, like the `cd` builtin, goes through /bin/sh.
+        if not _SHELL_META.search(command):
+            try:
+                args = shlex.split(command)
+            except ValueError:
+                args = None
+
+            if args:
+                try:
+                    return self._run_command(args)
+                except (FileNotFoundError, PermissionError):
+                    pass
+
+        return self._run_command(command, shell=True)
+
+    def _run_command(self, args, shell: bool = False) -> str:
+        # stderr goes to the same file as stdout, so the output is interleaved
+        # the way it would be in a terminal
+        kwargs = dict(shell=shell, stderr=subprocess.STDOUT, cwd=self.wd)
+
+        if not hasattr(os, 'memfd_create'):  # Not Linux
+            return subprocess.run(args, stdout=subprocess.PIPE, encoding='utf-8',
+                                  errors='replace', **kwargs).stdout
+
+        # Capture into an in-memory file rather than a pipe. There is nothing
+        # to drain while the command runs, and a command that leaves a
+        # background process holding stdout open doesn't block the read
+        with open(os.memfd_create('pptools-shell', os.MFD_CLOEXEC), 'r',
+                  encoding='utf-8', errors='replace') as f:
+            subprocess.run(args, stdout=f, **kwargs)
+            f.seek(0)
+            return f.read()
 
     def web_search(self, query: str):
         """
@@ -184,11 +290,10 @@ class PPTools(Tool):
         Args:
             query (str): The query string to search for.
         """
-        from duckduckgo_search import DDGS
+        from itertools import islice
 
-        with DDGS() as ddgs:
-            results = [r for r in ddgs.text(query, max_results=5)]
-            return json.dumps(results, indent=2)
+        results = list(islice(self._ddgs.text(query, max_results=5), 5))
+        return dumps(results)
 
     def store_document(self, title: str = None, text: str = None,
                        description: str = None,
@@ -220,11 +325,16 @@ class PPTools(Tool):
             dict: A dictionary with non-None arguments used in the document.
         """
 
-        if source.startswith('wiki:'):
+        if source and source.startswith('wiki:'):
             _, pageid = source.split(':')
-            page = wikipedia.page(pageid=int(pageid))
-            text = page.content
-            description = page.summary[:250]
+            page = self._wikipedia_page(int(pageid))
+            text = page['content']
+            description = page['summary'][:250]
+        elif text is None:
+            source = self._local_source(source)
+
+        # New documents may change the results of any search
+        self._search_library.cache_clear()
 
         return self.library.add_document(
             title=title, text=text,
@@ -232,6 +342,14 @@ class PPTools(Tool):
             source=source, tags=tags
         )
 
+    def _local_source(self, source: str | None) -> str | None:
+        """Resolve a source that is a local path against the working directory,
+        since the library opens paths relative to the process's directory"""
+        if not source or source.startswith(('http:', 'https:')) or '://' in source:
+            return source
+
+        return str(self.wd.joinpath(source))
+
     def get_document(self, key: int) -> Any:
         """Retrieve a document from the library using its key.
 
@@ -258,12 +376,55 @@ class PPTools(Tool):
             dict|None: A list of documents that match the query.
         """
 
-        d = self.library.search(query)
+        d = self._search_library(query)
         try:
             return d[result_number]
         except IndexError:
             return None
 
+    def store_documents(self, documents: list[dict]) -> list[dict]:
+        """Store several documents in the library, faster than one at a time.
+
+        Each document is a dict with the same keys as the arguments to
+        store_document(): title, text, description, source and tags.
+
+        Args:
+            documents (list[dict]): The documents to store.
+
+        Returns:
+            list[dict]: A summary of each stored document.
+        """
+        docs = []
+        for d in documents:
+            d = dict(d)
+            source = d.get('source') or ''
+            if source.startswith('wiki:'):
+                _, pageid = source.split(':')
+                page = self._wikipedia_page(int(pageid))
+                d['text'] = page['content']
+                d['description'] = page['summary'][:250]
+            elif d.get('text') is None:
+                d['source'] = self._local_source(d.get('source'))
+            docs.append(d)
+
+        self._search_library.cache_clear()
+
+        return self.library.add_document_batch(docs)
+
+    def search_documents_multi(self, queries: list[str], result_number: int = 0) -> list:
+        """Search the library for several queries at once, in one request.
+
+        Args:
+            queries (list[str]): The search queries.
+            result_number (int): (Optional) Which result document to return for each query
+        Returns:
+            list: The result document for each query, or None for queries with
+            fewer results.
+        """
+        results = self.library.multi_search(queries)
+
+        return [d[result_number] if result_number < len(d) else None for d in results]
+
     def read_file(self, path: str, encoding=None) -> str:
         """
         Read text from a file.
@@ -289,23 +450,78 @@ class PPTools(Tool):
         self.fs.write(path, b, encoding=encoding)
         return f"wrote {len(b)} bytes to {path}"
 
+    def read_files(self, paths: list[str], encoding: str = None) -> dict:
+        """
+        Read text from several files at once.
+
+        Args:
+            paths (list[str]): The paths to the files to be read.
+            encoding (str, optional): The encoding to use for reading the files.
+
+        Returns:
+            dict: A mapping of each path to the content of the file.
+        """
+        return dict(zip(paths, self.fs.read_many(paths, encoding=encoding)))
+
+    def write_files(self, files: dict, encoding: str = None) -> str:
+        """
+        Write text to several files at once.
+
+        Args:
+            files (dict): A mapping of file paths to the text to write to them.
+            encoding (str, optional): The encoding to use for writing the files.
+        """
+        self.fs.write_many(files, encoding=encoding)
+        return f"wrote {sum(len(b) for b in files.values())} bytes to {len(files)} files"
+
+    def _wikipedia_page(self, pageid: int) -> dict:
+        """Return the content and summary of a wikipedia page, from the session
+        cache if it has been fetched before"""
+        key = f'wiki_page/{pageid}'
+
+        if self.session_cache is not None:
+            try:
+                return self.session_cache.get(key)
+            except KeyError:
+                pass
+
+        import wikipedia
+
+        p = wikipedia.page(pageid=pageid)
+        page = {'content': p.content, 'summary': p.summary}
+
+        if self.session_cache is not None:
+            self._cache_put(key, page)
+
+        return page
+
     def wikipedia_search(self, term: str):
         """Return the names of wikipedia pages that match the search term
 
         """
 
-        o = []
-        for page in wikipedia.search(term, results=10):
-            p = wikipedia.page(page, auto_suggest=False)
-            o.append({
-                'page_name': page,
-                'pageid': p.pageid,
-                'store_document_uri': f'wiki:{p.pageid}',
-                'url': p.url,
-                'summary': p.summary[:400]
-            })
+        from concurrent.futures import ThreadPoolExecutor
+
+        import wikipedia
 
-        return o
+        def get_page(page):
+            try:
+                p = wikipedia.page(page, auto_suggest=False)
+                return {
+                    'page_name': page,
+                    'pageid': p.pageid,
+                    'store_document_uri': f'wiki:{p.pageid}',
+                    'url': p.url,
+                    'summary': p.summary[:400]
+                }
+            except (wikipedia.exceptions.DisambiguationError, wikipedia.exceptions.PageError):
+                return None
+
+        # Fetch the pages concurrently; each one is a separate request
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            pages = executor.map(get_page, wikipedia.search(term, results=10))
+
+            return [p for p in pages if p is not None]
 
     def start_task(self, task_description: str):
         """Start a task with the specified analysis.
@@ -337,9 +553,25 @@ class PPTools(Tool):
 class TestCase(unittest.TestCase):
 
     def test_tool_spec(self):
-        tool = PPTools(None, None, Path('/Volumes/Cache/scratch'))
+        tool = PPTools(None, Path('/Volumes/Cache/scratch'))
         print(json.dumps(tool.specification(), indent=2))
 
+    def test_spec_types(self):
+        # OpenAI rejects the whole tools list if any type isn't a JSON Schema type
+        spec = tools_specification(PPTools)
+        for s in spec:
+            for t in schema_types(s['function']):
+                self.assertIn(t, JSON_SCHEMA_TYPES, s['function']['name'])
+
+        params = {s['function']['name']: s['function']['parameters']['properties'] for s in spec}
+        self.assertEqual(params['read_files']['paths']['type'], 'array')
+        self.assertEqual(params['read_files']['paths']['items'], {'type': 'string'})
+        self.assertEqual(params['write_files']['files']['type'], 'object')
+        self.assertEqual(params['store_documents']['documents']['type'], 'array')
+        self.assertEqual(params['store_documents']['documents']['items'], {'type': 'object'})
+        self.assertEqual(params['search_documents_multi']['queries']['type'], 'array')
+        self.assertEqual(params['search_documents_multi']['queries']['items'], {'type': 'string'})
+
     def test_basic(self):
         rc = ObjectStore.new(bucket='test', class_='FSObjectStore', path='/tmp/cache')
 
@@ -351,7 +583,8 @@ class TestCase(unittest.TestCase):
             }
         )
 
-        tool = PPTools(ts, rc, Path('/Volumes/Cache/scratch'))
+        tool = PPTools(ts, Path('/Volumes/Cache/scratch'))
+        tool.set_session_cache(rc)
 
         # print(json.dumps(tool.specification(), indent=4))
 
@@ -377,10 +610,47 @@ class TestCase(unittest.TestCase):
         self.assertEqual(r[0]['title'], 'Cleaning your Ears')
 
     def test_shell(self):
-        tool = PPTools(None, None, Path('/Volumes/Cache/scratch'))
+        tool = PPTools(None, Path('/Volumes/Cache/scratch'))
         o = tool.execute_code("!ls")
         print(o)
 
+    def test_shell_routing(self):
+        import tempfile
+        from unittest import mock
+
+        with tempfile.TemporaryDirectory() as d:
+            tool = PPTools(None, d, prewarm=False)
+
+            with mock.patch.object(PPTools, '_run_command', autospec=True,
+                                   side_effect=PPTools._run_command) as run:
+
+                # Simple commands are executed directly
+                self.assertEqual(tool.shell('echo "a  b"'), 'a  b\n')
+                run.assert_called_once_with(tool, ['echo', 'a  b'])
+
+                run.reset_mock()
+                self.assertEqual(Path(tool.shell('pwd').strip()), Path(d).resolve())
+                run.assert_called_once_with(tool, ['pwd'])
+
+                # Metacharacters go through the shell
+                for command, output in [('echo hi | tr a-z A-Z', 'HI\n'),
+                                        ('echo $0', '/bin/sh\n'),
+                                        ('echo one > f; cat f', 'one\n')]:
+                    run.reset_mock()
+                    self.assertEqual(tool.shell(command), output)
+                    run.assert_called_once_with(tool, command, shell=True)
+
+                # Builtins aren't executables, so they fall back to the shell
+                run.reset_mock()
+                self.assertEqual(tool.shell('cd /'), '')
+                self.assertEqual(run.call_args_list,
+                                 [mock.call(tool, ['cd', '/']), mock.call(tool, 'cd /', shell=True)])
+
+                # As do commands that don't split
+                run.reset_mock()
+                tool.shell('echo "unterminated')  # The shell's syntax error varies
+                run.assert_called_once_with(tool, 'echo "unterminated', shell=True)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,137 +1,264 @@
+import functools
 import inspect
-from typing import Any, Dict, List, Type, get_type_hints
+import json
+import os
+import sys
+import types
+from string import Formatter
+from typing import Any, Dict, List, Type, Union, get_args, get_origin, get_type_hints
 
 from docstring_parser import parse, DocstringStyle
-from termcolor import colored
 
 from pydantic import BaseModel
 from pathlib import Path
 from colored import Fore, Back, Style
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(o: Any, indent: int = None) -> str:
+    """Serialize an object to a JSON string, with orjson if it is installed.
+    orjson only indents by 2, so any indent gets 2 spaces. Objects orjson
+    can't encode, such as integers over 64 bits, are passed to json"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            return orjson.dumps(o, option=option).decode('utf8')
+        except orjson.JSONEncodeError:
+            pass
+
+    return json.dumps(o, indent=indent)
+
+
+def loads(s: str | bytes) -> Any:
+    """Parse a JSON string, with orjson if it is installed. Both parsers raise
+    a json.JSONDecodeError on bad input"""
+    return orjson.loads(s) if orjson is not None else json.loads(s)
+
+
+_TYPE_MAP = {
+    "str": "string",
+    "int": "integer",
+    "float": "number",
+    "bool": "boolean",
+    "dict": "object",
+    "list": "array",
+    "tuple": "array",
+    "set": "array",
+    "NoneType": "null",
+    "Any": "object",
+    "Optional": "object",
+}
+
+# The types that JSON Schema, and so the OpenAI tools API, accepts
+JSON_SCHEMA_TYPES = frozenset(("string", "number", "integer", "boolean", "object", "array", "null"))
+
 
 def map_types(v):
-    return {
-        "str": "string",
-        "int": "integer",
-        "Any": "object",
-        "list": "object",
-        "Optional": "object",
-    }.get(v, v)
+    return _TYPE_MAP.get(v, v)
+
+
+def type_schema(tp) -> Dict[str, Any]:
+    """Return the JSON Schema for a type annotation. Optional types are
+    described by their non-None type, and classes with no JSON equivalent,
+    such as pydantic models, are objects."""
+    origin = get_origin(tp)
+
+    if origin is Union or origin is types.UnionType:
+        args = [a for a in get_args(tp) if a is not type(None)]
+        if len(args) == 1:
+            return type_schema(args[0])
+        return {"anyOf": [type_schema(a) for a in args]}
+
+    name = tp if isinstance(tp, str) else getattr(origin or tp, '__name__', None)
+    t = _TYPE_MAP.get(name)
+
+    if t not in JSON_SCHEMA_TYPES:
+        return {"type": "object"}
+
+    if t == "array":
+        args = get_args(tp)
+        return {"type": "array", "items": type_schema(args[0]) if args else {}}
+
+    return {"type": t}
+
 
 def get_pydantic_model_spec(model: Type[BaseModel]) -> Dict[str, Any]:
     """Generate specification for Pydantic model fields."""
     spec = {}
     for field_name, field in model.model_fields.items():
         spec[field_name] = {
-            "type": map_types(field.annotation.__name__),
+            **type_schema(field.annotation),
             "description": field.description,
         }
     return spec
 
+
+def schema_types(schema):
+    """Yield every type named in a JSON Schema, or a tool specification"""
+    if isinstance(schema, dict):
+        for k, v in schema.items():
+            if k == "type" and isinstance(v, str):
+                yield v
+            else:
+                yield from schema_types(v)
+    elif isinstance(schema, list):
+        for v in schema:
+            yield from schema_types(v)
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_docstring(docstring: str):
+    """Parse a Google style docstring. Overridden methods that keep the same
+    docstring, and wrappers that copy it, share the parse"""
+    return parse(docstring, DocstringStyle.GOOGLE)
+
+
+@functools.lru_cache(maxsize=None)
+def method_specification(name: str, method) -> Dict[str, Any]:
+    """Generate the tool specification for one method. Methods don't change
+    after their class is defined, so each one is inspected once"""
+    sig = inspect.signature(method)
+    hints = get_type_hints(method)
+    docstring = method.__doc__
+    parsed_docstring = _parse_docstring(docstring) if docstring else None
+    param_docs = {p.arg_name: p for p in parsed_docstring.params} if parsed_docstring else {}
+
+    function_spec = {
+        "name": name,
+        "description": parsed_docstring.short_description
+        if parsed_docstring
+        else "",
+        "parameters": {"type": "object", "properties": {}},
+        "result": {
+            "type": "object",
+            "description": parsed_docstring.returns.description
+            if parsed_docstring and parsed_docstring.returns
+            else "",
+            "properties": {},
+        },
+    }
+
+    for param_name, param in sig.parameters.items():
+        if param_name == "self":
+            continue  # Skip the 'self' parameter
+
+        param_type = hints.get(param_name, Any)
+
+        param_doc = param_docs.get(param_name)
+        param_description = param_doc.description if param_doc else ""
+
+        if inspect.isclass(param_type) and issubclass(param_type, BaseModel):
+            function_spec["parameters"]["properties"][param_name] = {
+                "type": "object",
+                "description": param_description,
+                "properties": get_pydantic_model_spec(param_type),
+            }
+        else:
+            function_spec["parameters"]["properties"][param_name] = {
+                **type_schema(param_type),
+                "description": param_description,
+            }
+
+    return_type = hints.get("return", Any)
+
+    if inspect.isclass(return_type) and issubclass(return_type, BaseModel):
+        function_spec["result"] = {
+            "type": "object",
+            "properties": get_pydantic_model_spec(return_type),
+        }
+    else:
+        function_spec["result"].update(type_schema(return_type))
+
+    # Patch up bad formatting
+    function_spec = {"type": "function", "function": function_spec}
+
+    return function_spec
+
+
+def _class_functions(cls: Type) -> List[tuple]:
+    """Return (name, function) pairs for the plain and static methods of a
+    class and its bases, sorted by name, like inspect.getmembers(cls,
+    inspect.isfunction), but reading the class dicts rather than calling
+    getattr() on every attribute"""
+    functions = {}
+    for klass in cls.__mro__:
+        for name, v in vars(klass).items():
+            if name in functions:
+                continue  # Overridden in a subclass
+            if isinstance(v, staticmethod):
+                v = v.__func__
+            functions[name] = v
+
+    return sorted((name, v) for name, v in functions.items() if inspect.isfunction(v))
+
+
 def generate_tools_specification(cls: Type, include_methods = [], exclude_methods=[]) -> List[Dict[str, Any]]:
     """
     Generates a tools specification from a class's methods, annotations, and docstrings
     using the docstring_parser module. It excludes the 'self' parameter from methods.
     """
-    functions_spec = []
+    exclude_methods = exclude_methods or cls.exclude_methods
+    include_methods = include_methods or cls.include_methods
 
-    for name, method in inspect.getmembers(cls, inspect.isfunction):
-        if name.startswith("_"):
-            continue
+    return [
+        method_specification(name, method)
+        for name, method in _class_functions(cls)
+        if not name.startswith("_")
+        and name not in exclude_methods
+        and (not include_methods or name in include_methods)
+    ]
 
-        exclude_methods = exclude_methods or cls.exclude_methods
-        include_methods = include_methods or cls.include_methods
 
-        if name in exclude_methods:
-            continue
+@functools.lru_cache(maxsize=None)
+def _cached_tools_specification(cls: Type, include_methods: tuple, exclude_methods: tuple):
+    return generate_tools_specification(cls, list(include_methods), list(exclude_methods))
 
-        if include_methods and name not in include_methods:
-            continue
 
-        sig = inspect.signature(method)
-        docstring = method.__doc__
-        parsed_docstring = parse(docstring, DocstringStyle.GOOGLE) if docstring else None
-
-        function_spec = {
-            "name": name,
-            "description": parsed_docstring.short_description
-            if parsed_docstring
-            else "",
-            "parameters": {"type": "object", "properties": {}},
-            "result": {
-                "type": "object",
-                "description": parsed_docstring.returns.description
-                if parsed_docstring and parsed_docstring.returns
-                else "",
-                "properties": {},
-            },
-        }
+def tools_specification(cls: Type, include_methods=None, exclude_methods=None) -> List[Dict[str, Any]]:
+    """Memoized version of generate_tools_specification(). The specification
+    depends only on the class and the method lists, so it is generated once
+    for each combination. Don't modify the returned list."""
+    return _cached_tools_specification(cls, tuple(include_methods or ()), tuple(exclude_methods or ()))
 
-        for param_name, param in sig.parameters.items():
-            if param_name == "self":
-                continue  # Skip the 'self' parameter
 
-            param_type = param.annotation
-            if param_type == param.empty:
-                param_type = Any
-            else:
-                param_type = get_type_hints(method)[param_name]
-
-            param_doc = (
-                next(
-                    (p for p in parsed_docstring.params if p.arg_name == param_name),
-                    None,
-                )
-                if parsed_docstring
-                else None
-            )
-            param_description = param_doc.description if param_doc else ""
-
-            if inspect.isclass(param_type) and issubclass(param_type, BaseModel):
-                function_spec["parameters"]["properties"][param_name] = {
-                    "type": map_types(param_type.__name__),
-                    "description": param_description,
-                    "properties": get_pydantic_model_spec(param_type),
-                }
-            else:
-                function_spec["parameters"]["properties"][param_name] = {
-                    "type": map_types(param_type.__name__),
-                    "description": param_description,
-                }
-
-        return_type = sig.return_annotation
-        if return_type == sig.empty:
-            return_type = Any
-        else:
-            return_type = get_type_hints(method).get("return", Any)
+_RESET = "\x1b[0m"
 
-        if inspect.isclass(return_type) and issubclass(return_type, BaseModel):
-            function_spec["result"] = {
-                "type": return_type.__name__,
-                "properties": get_pydantic_model_spec(return_type),
-            }
-        else:
-            function_spec["result"]["type"] = (
-                return_type.__name__
-                if not isinstance(return_type, str)
-                else return_type
-            )
+_ROLE_COLORS = {
+    "system": "\x1b[31m",  # red
+    "user": "\x1b[32m",  # green
+    "assistant": "\x1b[34m",  # blue
+    "tool": "\x1b[35m",  # magenta
+}
 
-        # Patch up bad formatting
-        function_spec = {"type": "function", "function": function_spec}
 
-        functions_spec.append(function_spec)
+def _can_colorize() -> bool:
+    """Return True if output to stdout should be colored, with the same checks
+    as termcolor: the NO_COLOR, ANSI_COLORS_DISABLED, FORCE_COLOR and TERM
+    environment variables, then whether stdout is a terminal"""
+    if os.environ.get("ANSI_COLORS_DISABLED") or os.environ.get("NO_COLOR"):
+        return False
+    if os.environ.get("FORCE_COLOR"):
+        return True
+    if os.environ.get("TERM") == "dumb" or not hasattr(sys.stdout, "fileno"):
+        return False
 
-    return functions_spec
+    try:
+        return os.isatty(sys.stdout.fileno())
+    except OSError:
+        return sys.stdout.isatty()
 
 
 def pretty_print_conversation(messages):
-    role_to_color = {
-        "system": "red",
-        "user": "green",
-        "assistant": "blue",
-        "tool": "magenta",
-    }
+    parts = []
+
+    if _can_colorize():
+        colors, reset = _ROLE_COLORS, _RESET
+    else:
+        colors, reset = {}, ""
 
     for message in messages:
         try:
@@ -140,21 +267,25 @@ def pretty_print_conversation(messages):
             tool_call = (message.get("tool_calls", "") or "")[:120]
             name = message.get("name")
         except AttributeError:
-            print("BAD!", message)
+            parts.append(f"BAD! {message}\n")
             continue
 
         if role == "system":
-            print(colored(f"system: {content}\n", role_to_color[role]))
+            line = f"system: {content}"
         elif role == "user":
-            print(colored(f"user: {content}\n", role_to_color[role]))
+            line = f"user: {content}"
         elif role == "assistant" and tool_call:
-            print(colored(f"assistant: {tool_call}\n", role_to_color[role]))
+            line = f"assistant: {tool_call}"
         elif role == "assistant" and not tool_call:
-            print(colored(f"assistant: {content}\n", role_to_color[role]))
+            line = f"assistant: {content}"
         elif role == "tool":
-            print(colored(f"function ({name}): {content}\n", role_to_color[role]))
+            line = f"function ({name}): {content}"
         else:
-            print(colored(f"unknown: {content}\n"))
+            line = f"unknown: {content}"
+
+        parts.append(f"{colors.get(role, '')}{line}\n{reset}\n")
+
+    sys.stdout.write("".join(parts))
 
     # Models list from the OpenAI OpenAPI spec at
     # https://github.com/openai/openai-openapi/blob/master/openapi.yaml
@@ -206,22 +337,66 @@ costs = {  # noqa: F841
 
 def serialize(o: Any):
     """Serialize an object to JSON"""
-    import pandas as pd
-    import json
 
-    if isinstance(o, (pd.DataFrame, pd.Series)):
-        return o.to_json(orient='records')
-    else:
-        try:
-            return json.dumps(o)
-        except TypeError:
-            return repr(o)
+    # Only look at pandas for pandas objects, so serializing plain data
+    # doesn't import it
+    if type(o).__module__.startswith('pandas.'):
+        import pandas as pd
+
+        if isinstance(o, (pd.DataFrame, pd.Series)):
+            return o.to_json(orient='records')
+
+    try:
+        return dumps(o)
+    except TypeError:
+        return repr(o)
 
 def get_prompt(prompt_name:str) -> str:
     """Return a pre-configured prompt"""
     return Path(__file__).parent.joinpath('prompts', prompt_name+'.txt').read_text()
 
 
+_formatter = Formatter()
+
+
+def parse_template(templ: str) -> tuple:
+    """Split a format() template into (literal text, field name, format spec,
+    conversion) tuples"""
+    return tuple(_formatter.parse(templ))
+
+
+def _render_template(parsed: tuple, **slots) -> str:
+    parts = []
+    for lit, name, spec, conversion in parsed:
+        parts.append(lit)
+
+        if name is None:
+            continue
+
+        v = _formatter.get_field(name, (), slots)[0]
+        if v is None:
+            continue  # Left empty, rather than rendered as 'None'
+
+        parts.append(_formatter.format_field(_formatter.convert_field(v, conversion), spec))
+
+    return ''.join(parts)
+
+
+_render_template_cached = functools.lru_cache(maxsize=128)(_render_template)
+
+
+def render_template(parsed: tuple, **slots) -> str:
+    """Render a template from parse_template(), as format() would, except that
+    slots that are None are left empty. The result is cached, since the slot
+    values usually don't change between turns in the same state"""
+    try:
+        return _render_template_cached(parsed, **slots)
+    except TypeError:
+        # Slots from the model's JSON, such as a plan, may be lists or dicts,
+        # which can't be cache keys
+        return _render_template(parsed, **slots)
+
+
 def log_system(s):
     return f"{Fore.blue}{s}{Style.reset}"
 